@@ -0,0 +1,261 @@
+# Copyright (c) 2022, BlockProject 3D
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#       and/or other materials provided with the distribution.
+#     * Neither the name of BlockProject 3D nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Batch export of every root object of .blend files with BP3DExport.py
+# Usage: python BP3DBatchExport.py --blender blender --output out -j 4 [--option lod_count=2] a.blend b.blend
+# Each .blend file is exported by a background Blender running this script again:
+#     blender --background a.blend --python BP3DBatchExport.py -- --output out/a
+
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+MANIFEST_VERSION = 1
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def parseOptions(options):
+    # name=value pairs of BP3D_Export properties, values are read as JSON (true, 2, 0.5) and as strings otherwise
+    result = {}
+    for option in options:
+        name, _, value = option.partition("=")
+        try:
+            result[name] = json.loads(value)
+        except ValueError:
+            result[name] = value
+    return result
+
+def findRoots(viewLayer, pattern = "*", collection = ""):
+    # Objects with geometry and no geometry ancestor. The objects are walked like BP3D_Export walks the parts of an
+    # object, so everything with geometry below a root, even under an empty, is one of its parts and never a root
+    # itself. Objects hidden from render, such as the hull meshes of a convex decomposition, and objects of
+    # collections excluded from the view layer are left out
+    sys.path.insert(0, SCRIPT_DIR)
+    import BP3DExport
+    objects = list(viewLayer.objects)
+    hierarchy = BP3DExport.Hierarchy(objects)
+    names = {o.name_full for o in objects}
+    stack = [o for o in objects if o.parent == None or o.parent.name_full not in names]
+    roots = []
+    while (len(stack) > 0):
+        obj = stack.pop()
+        if (obj.type not in BP3DExport.GEOMETRY_TYPES):
+            stack.extend(hierarchy.children.get(obj.name_full, []))
+            continue
+        if (obj.hide_render or not fnmatch.fnmatchcase(obj.name, pattern)):
+            continue
+        if (collection != "" and collection not in [c.name for c in obj.users_collection]):
+            continue
+        roots.append(obj)
+    roots.sort(key=lambda o: o.name)
+    return roots
+
+def outputFiles(fileName, options):
+    # Every file an export to fileName with options may write (armature, animation, LODs, binary, profile)
+    sys.path.insert(0, SCRIPT_DIR)
+    import BP3DExport
+    return BP3DExport.outputFiles(fileName, options.get("lod_count", 0))
+
+def ensureExporter():
+    if (not hasattr(bpy.types, "B3D_OT_export")):
+        sys.path.insert(0, SCRIPT_DIR)
+        import BP3DExport
+        BP3DExport.register()
+
+def exportObject(obj, fileName, options):
+    # Runs BP3D_Export with obj as the active object, returns the written files. Outputs of an earlier export are
+    # removed first so that files this export does not write are not reported
+    outputs = outputFiles(fileName, options)
+    for path in outputs:
+        if (os.path.isfile(path)):
+            os.remove(path)
+    layer = bpy.context.view_layer
+    for o in layer.objects:
+        o.select_set(False)
+    obj.select_set(True)
+    layer.objects.active = obj
+    # The batch export always runs synchronously, a modal_export option would be passed twice
+    options = {name: value for name, value in options.items() if name != "modal_export"}
+    result = bpy.ops.b3d.export(filepath=fileName, modal_export=False, **options)
+    if (result != {'FINISHED'}):
+        raise RuntimeError("Export of {} returned {}".format(obj.name, result))
+    return [path for path in outputs if os.path.isfile(path)]
+
+def assetNames(roots):
+    # File name of every root. Several object names can clean to the same name ("Rock.001" and "Rock_001"), the later
+    # roots then get a numbered suffix. Names are compared ignoring case as on Windows and macOS file systems
+    cleaned = [bpy.path.clean_name(obj.name) for obj in roots]
+    taken = {name.lower() for name in cleaned}
+    used = set()
+    names = []
+    for obj, name in zip(roots, cleaned):
+        unique = name
+        suffix = 2
+        while (unique.lower() in used or (unique != name and unique.lower() in taken)):
+            unique = "{}_{}".format(name, suffix)
+            suffix += 1
+        if (unique != name):
+            print("BP3D batch: {} is exported as {} since another object cleans to the same file name".format(obj.name, unique))
+        used.add(unique.lower())
+        names.append(unique)
+    return names
+
+def exportScene(viewLayer, outputDir, options, pattern = "*", collection = ""):
+    # Exports every root object of viewLayer, the view layer of the context, to outputDir/<object>.bp3d.obj, returns
+    # a manifest entry per object
+    ensureExporter()
+    os.makedirs(outputDir, exist_ok=True)
+    assets = []
+    roots = findRoots(viewLayer, pattern, collection)
+    for obj, name in zip(roots, assetNames(roots)):
+        start = time.perf_counter()
+        outputs = exportObject(obj, os.path.join(outputDir, name + ".bp3d.obj"), options)
+        assets.append({
+            "object": obj.name,
+            "seconds": time.perf_counter() - start,
+            "outputs": [{"path": path, "size": os.path.getsize(path)} for path in outputs]
+        })
+        print("BP3D batch: {} exported in {:.2f}s".format(obj.name, assets[-1]["seconds"]))
+    return assets
+
+def runInBlender(argv):
+    parser = argparse.ArgumentParser(prog="BP3DBatchExport.py (in Blender)")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--result", default="")
+    parser.add_argument("--filter", default="*")
+    parser.add_argument("--collection", default="")
+    parser.add_argument("--option", action="append", default=[])
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    assets = exportScene(bpy.context.view_layer, args.output, parseOptions(args.option), args.filter, args.collection)
+    if (args.result != ""):
+        with open(args.result, "w") as file:
+            json.dump({"assets": assets, "seconds": time.perf_counter() - start}, file)
+
+def fileHash(h, fileName):
+    with open(fileName, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            h.update(block)
+
+def assetKey(blendFile, args):
+    # Changes when the .blend file, the exporter or the export settings change
+    h = hashlib.sha1(json.dumps([MANIFEST_VERSION, args.filter, args.collection, sorted(args.option)]).encode("utf8"))
+    for fileName in (blendFile, os.path.join(SCRIPT_DIR, "BP3DExport.py"), os.path.abspath(__file__)):
+        fileHash(h, fileName)
+    return h.hexdigest()
+
+def upToDate(entry, key):
+    if (entry == None or entry.get("key") != key or entry.get("status") != "exported"):
+        return False
+    for asset in entry["assets"]:
+        for output in asset["outputs"]:
+            if (not os.path.isfile(output["path"]) or os.path.getsize(output["path"]) != output["size"]):
+                return False
+    return True
+
+def exportBlend(blendFile, outputDir, args):
+    # Runs a background Blender on blendFile, returns its manifest entry
+    fd, resultFile = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    command = [args.blender, "--background", "--factory-startup", blendFile, "--python-exit-code", "1", "--python", os.path.abspath(__file__), "--",
+        "--output", outputDir, "--result", resultFile, "--filter", args.filter, "--collection", args.collection]
+    for option in args.option:
+        command += ["--option", option]
+    start = time.perf_counter()
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        entry = {"status": "exported", "seconds": time.perf_counter() - start, "assets": []}
+        if (process.returncode != 0):
+            entry["status"] = "failed"
+            entry["log"] = process.stdout[-4096:]
+        else:
+            with open(resultFile) as file:
+                entry["assets"] = json.load(file)["assets"]
+        return entry
+    finally:
+        os.remove(resultFile)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Export every root object of .blend files with BP3DExport.py")
+    parser.add_argument("files", nargs="+", help=".blend files to export")
+    parser.add_argument("--blender", default="blender", help="Blender executable")
+    parser.add_argument("--output", required=True, help="Output directory, every .blend file gets a sub directory")
+    parser.add_argument("--manifest", default="", help="Manifest file, defaults to manifest.json in the output directory")
+    parser.add_argument("--filter", default="*", help="Only export root objects whose name matches this pattern")
+    parser.add_argument("--collection", default="", help="Only export root objects linked to this collection")
+    parser.add_argument("--option", action="append", default=[], help="BP3D_Export property as name=value, can be repeated")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of Blender instances run at once")
+    parser.add_argument("--force", action="store_true", help="Export unchanged files too")
+    args = parser.parse_args(argv)
+    manifestFile = args.manifest if args.manifest != "" else os.path.join(args.output, "manifest.json")
+    manifest = {"version": MANIFEST_VERSION, "files": {}}
+    if (os.path.isfile(manifestFile)):
+        with open(manifestFile) as file:
+            manifest = json.load(file)
+        if (manifest.get("version") != MANIFEST_VERSION):
+            manifest = {"version": MANIFEST_VERSION, "files": {}}
+    jobs = {}
+    with concurrent.futures.ThreadPoolExecutor(max(args.jobs, 1)) as pool:
+        for blendFile in args.files:
+            blendFile = os.path.abspath(blendFile)
+            key = assetKey(blendFile, args)
+            if (not args.force and upToDate(manifest["files"].get(blendFile), key)):
+                print("BP3D batch: {} is up to date".format(blendFile))
+                continue
+            outputDir = os.path.join(os.path.abspath(args.output), os.path.splitext(os.path.basename(blendFile))[0])
+            jobs[pool.submit(exportBlend, blendFile, outputDir, args)] = (blendFile, key)
+        failed = 0
+        for job in concurrent.futures.as_completed(jobs):
+            blendFile, key = jobs[job]
+            entry = job.result()
+            entry["key"] = key
+            manifest["files"][blendFile] = entry
+            if (entry["status"] != "exported"):
+                failed += 1
+            print("BP3D batch: {} {} in {:.2f}s ({} objects)".format(blendFile, entry["status"], entry["seconds"], len(entry["assets"])))
+    os.makedirs(os.path.dirname(os.path.abspath(manifestFile)), exist_ok=True)
+    with open(manifestFile, "w") as file:
+        json.dump(manifest, file, indent=4)
+    return 1 if failed > 0 else 0
+
+if __name__ == "__main__":
+    if (bpy != None):
+        runInBlender(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
+    else:
+        sys.exit(main(sys.argv[1:]))
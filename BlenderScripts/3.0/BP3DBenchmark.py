@@ -0,0 +1,400 @@
+# Copyright (c) 2022, BlockProject 3D
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#       and/or other materials provided with the distribution.
+#     * Neither the name of BlockProject 3D nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Benchmark of BP3DExport.py on synthetic scenes, runs with a regular Python (numpy required) and no Blender
+# Usage: python BP3DBenchmark.py [--triangles 1000 100000] [--parts 16] [--frames 2000 --bones 200] [--memory]
+# The bpy, bmesh and bpy_extras modules are replaced by stand-ins providing the few calls the exporter makes, the
+# timings therefore cover the exporter code and not the Blender side of to_mesh or bmesh.ops.triangulate
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import numpy as np
+
+class Collection:
+    """Stand-in for a bpy collection property: foreach_get reads from numpy arrays, items are built on iteration"""
+    def __init__(self, count, arrays, item = None):
+        self.count = count
+        self.arrays = arrays
+        self.item = item
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.item(i)
+
+    def foreach_get(self, name, out):
+        out[:] = self.arrays[name].reshape(-1)
+
+class Group:
+    __slots__ = ("group", "weight")
+
+    def __init__(self, group, weight):
+        self.group = group
+        self.weight = weight
+
+class Vertex:
+    __slots__ = ("groups",)
+
+    def __init__(self, groups):
+        self.groups = groups
+
+class UVLayers(list):
+    @property
+    def active(self):
+        return self[0]
+
+class Mesh:
+    """Stand-in for bpy.types.Mesh built from polygon arrays, influences are (starts, group ids, weights) per vertex"""
+    def __init__(self, positions, normals, uvs, loopVertices, loopTotals, influences = None):
+        self.positions = positions
+        self.normals = normals
+        self.uvs = uvs
+        self.loopVertices = loopVertices
+        self.loopTotals = loopTotals
+        self.influences = influences
+        self.update()
+
+    def update(self):
+        loopStarts = np.zeros(len(self.loopTotals), dtype=np.int32)
+        np.cumsum(self.loopTotals[:-1], out=loopStarts[1:])
+        self.vertices = Collection(len(self.positions), {"co": self.positions}, self.vertex)
+        self.loops = Collection(len(self.loopVertices), {"normal": self.normals, "vertex_index": self.loopVertices})
+        self.polygons = Collection(len(self.loopTotals), {"loop_start": loopStarts, "loop_total": self.loopTotals})
+        self.uv_layers = UVLayers([types.SimpleNamespace(data=Collection(len(self.uvs), {"uv": self.uvs}))])
+        self.loop_triangles = Collection(0, {"loops": np.zeros(0, dtype=np.int32)})
+
+    def vertex(self, i):
+        groups = []
+        if (self.influences != None):
+            starts, groupIds, weights = self.influences
+            groups = [Group(g, w) for g, w in zip(groupIds[starts[i]:starts[i + 1]].tolist(), weights[starts[i]:starts[i + 1]].tolist())]
+        return Vertex(groups)
+
+    def triangleLoops(self):
+        # Fan triangulation of every polygon
+        loopStarts = self.polygons.arrays["loop_start"]
+        triangles = self.loopTotals - 2
+        polygon = np.repeat(np.arange(len(self.loopTotals)), triangles)
+        corner = np.arange(len(polygon)) - np.repeat(np.cumsum(triangles) - triangles, triangles)
+        first = loopStarts[polygon]
+        return np.column_stack((first, first + corner + 1, first + corner + 2)).astype(np.int32)
+
+    def calc_normals_split(self):
+        pass
+
+    def calc_loop_triangles(self):
+        loops = self.triangleLoops()
+        self.loop_triangles = Collection(len(loops), {"loops": loops})
+
+    def flip_normals(self):
+        pass
+
+class BMesh:
+    """Stand-in for bmesh.types.BMesh, triangulate and transform work on the arrays of the mesh it was loaded from"""
+    def __init__(self):
+        self.mesh = None
+        self.faces = []
+
+    def from_mesh(self, mesh):
+        self.mesh = mesh
+
+    def to_mesh(self, mesh):
+        pass
+
+    def free(self):
+        pass
+
+def bmeshTriangulate(bm, faces):
+    mesh = bm.mesh
+    loops = mesh.triangleLoops().reshape(-1)
+    mesh.normals = mesh.normals[loops]
+    mesh.uvs = mesh.uvs[loops]
+    mesh.loopVertices = mesh.loopVertices[loops]
+    mesh.loopTotals = np.full(len(loops) // 3, 3, dtype=np.int32)
+    mesh.update()
+
+def bmeshTransform(bm, matrix):
+    matrix = np.array(matrix, dtype=np.float64)
+    mesh = bm.mesh
+    mesh.positions = (mesh.positions @ matrix[0:3, 0:3].T + matrix[0:3, 3]).astype(np.float32)
+    mesh.update()
+
+class Matrix(list):
+    def determinant(self):
+        return float(np.linalg.det(np.array(self, dtype=np.float64)))
+
+def translation(x, y, z):
+    return Matrix([[1.0, 0.0, 0.0, x], [0.0, 1.0, 0.0, y], [0.0, 0.0, 1.0, z], [0.0, 0.0, 0.0, 1.0]])
+
+class Object:
+    """Stand-in for a mesh bpy.types.Object, it is its own evaluated object"""
+    def __init__(self, name, mesh, parent = None, matrix = None, vertexGroups = (), modifiers = ()):
+        self.name = name
+        self.name_full = name
+        self.type = "MESH"
+        self.data = types.SimpleNamespace(name_full=name)
+        self.mesh = mesh
+        self.parent = parent
+        self.matrix_world = matrix if matrix != None else translation(0.0, 0.0, 0.0)
+        self.vertex_groups = [types.SimpleNamespace(name=name) for name in vertexGroups]
+        self.modifiers = list(modifiers)
+        self.users_collection = []
+
+    def visible_get(self):
+        return True
+
+    def evaluated_get(self, depsgraph):
+        return self
+
+    def to_mesh(self):
+        # Blender builds a new mesh on every call, bmesh then modifies that copy
+        return copy.copy(self.mesh)
+
+    def to_mesh_clear(self):
+        pass
+
+class FCurve:
+    """Stand-in for bpy.types.FCurve evaluating a sine wave"""
+    def __init__(self, dataPath, index, amplitude, period, phase):
+        self.data_path = dataPath
+        self.array_index = index
+        self.mute = False
+        self.amplitude = amplitude
+        self.period = period
+        self.phase = phase
+
+    def evaluate(self, frame):
+        return self.amplitude * math.sin(frame * 2 * math.pi / self.period + self.phase)
+
+class PoseBone:
+    def __init__(self, name):
+        self.name = name
+        self.location = (0.0, 0.0, 0.0)
+        self.scale = (1.0, 1.0, 1.0)
+        self.rotation_quaternion = (1.0, 0.0, 0.0, 0.0)
+
+    def path_from_id(self, prop):
+        return 'pose.bones["{}"].{}'.format(self.name, prop)
+
+class Scene:
+    def __init__(self, objects, frames):
+        self.objects = objects
+        self.frame_start = 1
+        self.frame_end = frames
+        self.frame_current = 1
+
+    def frame_set(self, frame):
+        self.frame_current = frame
+
+def installStandIns():
+    # Registers the stand-in modules, BP3DExport.py must be imported after this
+    def prop(**settings):
+        return settings.get("default")
+    class Operator:
+        def report(self, level, message):
+            print(message)
+    bpy = types.ModuleType("bpy")
+    bpy.props = types.SimpleNamespace(BoolProperty=prop, IntProperty=prop, FloatProperty=prop, StringProperty=prop, EnumProperty=prop)
+    bpy.types = types.SimpleNamespace(Operator=Operator, Object=Object, TOPBAR_MT_file_export=types.SimpleNamespace(append=lambda f: None, remove=lambda f: None))
+    bpy.utils = types.ModuleType("bpy.utils")
+    bpy.utils.register_class = lambda c: None
+    bpy.utils.unregister_class = lambda c: None
+    bpy.path = types.SimpleNamespace(abspath=lambda p: p)
+    bpy.app = types.SimpleNamespace(background=True)
+    bpy.data = types.SimpleNamespace(objects=[])
+    bmesh = types.ModuleType("bmesh")
+    bmesh.new = BMesh
+    bmesh.ops = types.SimpleNamespace(triangulate=bmeshTriangulate, transform=bmeshTransform)
+    extras = types.ModuleType("bpy_extras")
+    extras.io_utils = types.ModuleType("bpy_extras.io_utils")
+    extras.io_utils.ExportHelper = type("ExportHelper", (), {})
+    sys.modules.update({"bpy": bpy, "bpy.utils": bpy.utils, "bmesh": bmesh, "bpy_extras": extras, "bpy_extras.io_utils": extras.io_utils})
+
+def gridMesh(triangles, seed, bones = 0):
+    # Height field made of quads (2 triangles each) with smooth normals and a UV seam every 16 columns, with bones the
+    # vertices get up to 4 influences of neighbouring bones
+    rng = np.random.default_rng(seed)
+    side = max(int(math.ceil(math.sqrt(triangles / 2))), 1)
+    rows = max(int(math.ceil(triangles / 2 / side)), 1)
+    x, y = np.meshgrid(np.arange(side + 1, dtype=np.float32), np.arange(rows + 1, dtype=np.float32))
+    z = np.sin(x * 0.3) * np.cos(y * 0.2) + rng.random(x.shape, dtype=np.float32) * 0.05
+    positions = np.column_stack((x.reshape(-1), y.reshape(-1), z.reshape(-1))).astype(np.float32)
+    gy, gx = np.gradient(z)
+    normals = np.column_stack((-gx.reshape(-1), -gy.reshape(-1), np.ones(len(positions), dtype=np.float32)))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    i, j = np.meshgrid(np.arange(side), np.arange(rows))
+    first = (j * (side + 1) + i).reshape(-1)
+    loopVertices = np.column_stack((first, first + 1, first + side + 2, first + side + 1)).reshape(-1).astype(np.int32)
+    column = np.column_stack((i.reshape(-1), i.reshape(-1) + 1, i.reshape(-1) + 1, i.reshape(-1))).reshape(-1)
+    # Corners on a seam column get the UV of the next island
+    u = np.where((column % 16 == 0) & (np.repeat(i.reshape(-1), 4) != column), 16.0, column % 16) / 16.0
+    uvs = np.column_stack((u, positions[loopVertices, 1] / max(rows, 1))).astype(np.float32)
+    influences = None
+    if (bones > 0):
+        count = len(positions)
+        perVertex = rng.integers(1, 5, count)
+        starts = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(perVertex, out=starts[1:])
+        vertex = np.repeat(np.arange(count), perVertex)
+        rank = np.arange(len(vertex)) - starts[vertex]
+        groupIds = ((positions[vertex, 0] / (side + 1) * bones).astype(np.int64) + rank) % bones
+        weights = rng.random(len(vertex), dtype=np.float32)
+        influences = (starts, groupIds, weights)
+    return Mesh(positions, normals[loopVertices].astype(np.float32), uvs, loopVertices, np.full(len(first), 4, dtype=np.int32), influences)
+
+def armatureObject(bones, seed):
+    rng = np.random.default_rng(seed)
+    names = ["bone{}".format(i) for i in range(bones)]
+    fcurves = []
+    for name in names:
+        for prop, width in (("location", 3), ("rotation_quaternion", 4)):
+            for index in range(width):
+                fcurves.append(FCurve('pose.bones["{}"].{}'.format(name, prop), index, float(rng.random()), float(rng.uniform(20, 200)), float(rng.random() * 6)))
+    animation = types.SimpleNamespace(drivers=[], nla_tracks=[], use_tweak_mode=False, action_blend_type="REPLACE", action_influence=1.0, action=types.SimpleNamespace(fcurves=fcurves))
+    data = types.SimpleNamespace(bones=[types.SimpleNamespace(name=name, head=(0.0, float(i), 0.0), tail=(0.0, float(i) + 1, 0.0)) for i, name in enumerate(names)])
+    return types.SimpleNamespace(name="Armature", type="ARMATURE", parent=None, data=data, pose=types.SimpleNamespace(bones=[PoseBone(name) for name in names]), animation_data=animation)
+
+def buildScene(triangles, parts, frames, bones, seed = 0):
+    # Returns (context, triangle count), the triangles are split between parts parented to the first one
+    armature = armatureObject(bones, seed) if bones > 0 else None
+    modifiers = [types.SimpleNamespace(type="ARMATURE", name="Armature", object=armature)] if armature != None else []
+    groups = ["bone{}".format(i) for i in range(bones)]
+    objects = []
+    for i in range(parts):
+        mesh = gridMesh(max(triangles // parts, 2), seed + i, bones)
+        objects.append(Object("Part{:04}".format(i), mesh, objects[0] if i > 0 else None, translation(float(i), 0.0, 0.0), groups, modifiers if i == 0 else ()))
+    context = types.SimpleNamespace(object=objects[0], scene=Scene(objects, frames), window=None, evaluated_depsgraph_get=lambda: None)
+    return (context, sum(len(o.mesh.triangleLoops()) for o in objects))
+
+def runExport(module, context, options, directory, memory):
+    op = module.BP3D_Export()
+    for name, default in module.BP3D_Export.__annotations__.items():
+        setattr(op, name, default)
+    for name, value in options.items():
+        setattr(op, name, value)
+    op.filepath = os.path.join(directory, "bench.bp3d.obj")
+    op.profiling = "REPORT"
+    if (memory):
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            op.execute(context)
+    finally:
+        if (memory):
+            tracemalloc.stop()
+    seconds = time.perf_counter() - start
+    with open(os.path.join(directory, "bench.profile.json")) as file:
+        report = json.load(file)
+    report["wallSeconds"] = seconds
+    return report
+
+def parseOptions(options):
+    result = {}
+    for option in options:
+        name, _, value = option.partition("=")
+        try:
+            result[name] = json.loads(value)
+        except ValueError:
+            result[name] = value
+    return result
+
+def printReport(name, triangles, samples, report):
+    print("{}: {:.3f}s, {:.2f} M triangles/s, {:.1f} MB written".format(name, report["wallSeconds"], triangles / report["wallSeconds"] / 1e6, sum(report["files"].values()) / 1048576))
+    print("    {:<20} {:>10} {:>8} {:>16} {:>10} {:>10}".format("stage", "seconds", "calls", "throughput", "written MB", "peak MB"))
+    for stage, total in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        if (stage.startswith("animation")):
+            throughput = "{:.2f} M samples/s".format(samples / max(total["seconds"], 1e-9) / 1e6)
+        else:
+            throughput = "{:.2f} M tris/s".format(triangles / max(total["seconds"], 1e-9) / 1e6)
+        peak = "{:.1f}".format(total["peakBytes"] / 1048576) if "peakBytes" in total else "-"
+        print("    {:<20} {:>10.4f} {:>8} {:>16} {:>10.2f} {:>10}".format(stage, total["seconds"], total["calls"], throughput, total.get("bytes", 0) / 1048576, peak))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark BP3DExport.py on synthetic scenes without Blender")
+    parser.add_argument("--triangles", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], help="Triangle counts of the single mesh scenarios (up to 10000000)")
+    parser.add_argument("--parts", type=int, default=16, help="Parts of the assembly scenario, 0 skips it")
+    parser.add_argument("--assembly-triangles", type=int, default=200000, help="Triangles of the whole assembly")
+    parser.add_argument("--frames", type=int, default=2000, help="Frames of the animation scenario, 0 skips it")
+    parser.add_argument("--bones", type=int, default=200, help="Bones of the animation scenario")
+    parser.add_argument("--option", action="append", default=[], help="BP3D_Export property as name=value, can be repeated")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per scenario, the fastest is reported")
+    parser.add_argument("--memory", action="store_true", help="Trace memory to report the peak of every stage (slows the export down)")
+    parser.add_argument("--json", default="", help="Write the results to this file")
+    parser.add_argument("--baseline", default="", help="Results of a previous run, fail when a scenario got slower")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="Allowed slow down against the baseline (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+    installStandIns()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import BP3DExport
+    options = parseOptions(args.option)
+    scenarios = [("mesh {}".format(n), n, 1, 0, 0) for n in args.triangles]
+    if (args.parts > 0):
+        scenarios.append(("assembly {}x{}".format(args.parts, args.assembly_triangles // args.parts), args.assembly_triangles, args.parts, 0, 0))
+    if (args.frames > 0):
+        scenarios.append(("animation {} frames {} bones".format(args.frames, args.bones), 10000, 1, args.frames, args.bones))
+    results = {}
+    for name, triangles, parts, frames, bones in scenarios:
+        context, triangles = buildScene(triangles, parts, frames, bones)
+        best = None
+        for _ in range(max(args.repeat, 1)):
+            with tempfile.TemporaryDirectory() as directory:
+                report = runExport(BP3DExport, context, options, directory, args.memory)
+            if (best == None or report["wallSeconds"] < best["wallSeconds"]):
+                best = report
+        printReport(name, triangles, frames * bones, best)
+        results[name] = {"seconds": best["wallSeconds"], "triangles": triangles, "stages": best["stages"], "files": best["files"]}
+    if (args.json != ""):
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=4)
+    if (args.baseline != ""):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        failed = False
+        for name, result in results.items():
+            if (name in baseline and result["seconds"] > baseline[name]["seconds"] * (1 + args.max_regression)):
+                print("Regression in {}: {:.3f}s against {:.3f}s".format(name, result["seconds"], baseline[name]["seconds"]))
+                failed = True
+        if (failed):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
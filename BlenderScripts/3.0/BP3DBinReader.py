@@ -0,0 +1,269 @@
+# Copyright (c) 2022, BlockProject 3D
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright notice,
+#       this list of conditions and the following disclaimer in the documentation
+#       and/or other materials provided with the distribution.
+#     * Neither the name of BlockProject 3D nor the names of its contributors
+#       may be used to endorse or promote products derived from this software
+#       without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Reader for the .bp3d.bin companion file written by BP3DExport.py
+# Usage: python BP3DBinReader.py model.bp3d.bin
+
+import mmap
+import struct
+import sys
+from array import array
+
+MAGIC = b"BP3DBIN\0"
+VERSION = 3
+ALIGNMENT = 16
+FLAG_ARMATURE = 1
+FLAG_ANIMATION = 2
+FLAG_VERTEX_STREAM = 4
+FLAG_INSTANCES = 8
+HEADER = struct.Struct("<8sIIIIQQQ")
+# Version 2 appends the vertex stream table offset to the header
+HEADER_STREAMS = struct.Struct("<Q")
+# Version 3 then appends the instance table offset
+HEADER_INSTANCES = struct.Struct("<Q")
+SECTION = struct.Struct("<6I8Q")
+BONE = struct.Struct("<II6f")
+ANIMATION = struct.Struct("<IIQQQ")
+STREAM = struct.Struct("<3I4x5Q")
+INSTANCES = struct.Struct("<I4xQQ")
+
+class FormatError(ValueError):
+    pass
+
+class Section:
+    """One SubMaterial: every array is a flat memoryview, corners hold (vertex, uv, normal) 0 based ids"""
+    def __init__(self, model, index, entry):
+        vcount, ncount, uvcount, ccount, fcount, icount = entry[0:6]
+        self.index = index
+        self.positions = model.slice(entry[6], vcount * 3, "f")
+        self.normals = model.slice(entry[7], ncount * 3, "f")
+        self.uvs = model.slice(entry[8], uvcount * 2, "f")
+        self.corners = model.slice(entry[9], ccount * 3, "I")
+        self.faceStarts = model.slice(entry[10], fcount + 1, "I")
+        self.influenceStarts = None
+        self.boneIds = None
+        self.weights = None
+        self.stream = None
+        if (model.flags & FLAG_ARMATURE):
+            self.influenceStarts = model.slice(entry[11], vcount + 1, "I")
+            self.boneIds = model.slice(entry[12], icount, "I")
+            self.weights = model.slice(entry[13], icount, "f")
+
+    def validate(self, boneCount):
+        vcount = len(self.positions) // 3
+        uvcount = len(self.uvs) // 2
+        ncount = len(self.normals) // 3
+        for i in range(0, len(self.corners), 3):
+            if (self.corners[i] >= vcount or self.corners[i + 1] >= uvcount or self.corners[i + 2] >= ncount):
+                raise FormatError("Section {}: corner {} is out of range".format(self.index, i // 3))
+        checkStarts(self.faceStarts, len(self.corners) // 3, "Section {}: face starts".format(self.index))
+        if (self.influenceStarts != None):
+            checkStarts(self.influenceStarts, len(self.boneIds), "Section {}: influence starts".format(self.index))
+            checkBones(self.boneIds, self.weights, boneCount, "Section {}".format(self.index))
+        if (self.stream != None):
+            self.stream.validate(self.index, boneCount)
+
+class VertexStream:
+    """Unified vertices of a section: vertices is interleaved (position x3, normal x3, uv x2), indices lists triangles"""
+    def __init__(self, model, entry):
+        vcount, icount, influenceCount = entry[0:3]
+        self.vertices = model.slice(entry[3], vcount * 8, "f")
+        self.indices = model.slice(entry[4], icount, "I")
+        self.influenceStarts = None
+        self.boneIds = None
+        self.weights = None
+        if (model.flags & FLAG_ARMATURE):
+            self.influenceStarts = model.slice(entry[5], vcount + 1, "I")
+            self.boneIds = model.slice(entry[6], influenceCount, "I")
+            self.weights = model.slice(entry[7], influenceCount, "f")
+
+    def validate(self, index, boneCount):
+        vcount = len(self.vertices) // 8
+        if (len(self.indices) % 3 != 0):
+            raise FormatError("Section {}: vertex stream index count is not a multiple of 3".format(index))
+        for i in self.indices:
+            if (i >= vcount):
+                raise FormatError("Section {}: vertex stream index {} is out of range".format(index, i))
+        if (self.influenceStarts != None):
+            checkStarts(self.influenceStarts, len(self.boneIds), "Section {}: vertex stream influence starts".format(index))
+            checkBones(self.boneIds, self.weights, boneCount, "Section {}: vertex stream".format(index))
+
+class Animation:
+    """Sampled frames: transforms holds position x3, scale x3 and rotation quaternion x4 per frame and track"""
+    def __init__(self, model, offset):
+        frameCount, trackCount, framesOffset, tracksOffset, transformsOffset = model.unpack(ANIMATION, offset)
+        self.frames = model.slice(framesOffset, frameCount, "i")
+        self.tracks = model.slice(tracksOffset, trackCount, "I")
+        self.transforms = model.slice(transformsOffset, frameCount * trackCount * 10, "f")
+
+    def transform(self, frame, track):
+        i = (frame * len(self.tracks) + track) * 10
+        return self.transforms[i:i + 10]
+
+class Instances:
+    """Placements of object space sections: sections holds the section index and transforms the 3x4 world matrix of each instance"""
+    def __init__(self, model, offset):
+        count, sectionsOffset, transformsOffset = model.unpack(INSTANCES, offset)
+        self.sections = model.slice(sectionsOffset, count, "I")
+        self.transforms = model.slice(transformsOffset, count * 12, "f")
+
+    def transform(self, instance):
+        return self.transforms[instance * 12:instance * 12 + 12]
+
+    def validate(self, sectionCount):
+        for section in self.sections:
+            if (section >= sectionCount):
+                raise FormatError("Instance section {} is out of range".format(section))
+
+def checkBones(boneIds, weights, boneCount, what):
+    # Bone id 0 pads fixed width influences and always comes with a weight of 0
+    for boneId, weight in zip(boneIds, weights):
+        if (boneId > boneCount or (boneId == 0 and weight != 0)):
+            raise FormatError("{}: bone id {} is out of range".format(what, boneId))
+
+def checkStarts(starts, total, what):
+    if (len(starts) == 0 or starts[0] != 0 or starts[-1] != total):
+        raise FormatError("{} do not cover {} entries".format(what, total))
+    for i in range(1, len(starts)):
+        if (starts[i] < starts[i - 1]):
+            raise FormatError("{} are not sorted".format(what))
+
+class BinaryModel:
+    """Memory maps a .bp3d.bin file; the arrays are views into the mapping which are only copied on big endian hosts"""
+    def __init__(self, fileName):
+        self.file = open(fileName, "rb")
+        self.map = None
+        self.views = []
+        try:
+            self.load()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self):
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = self.view(memoryview(self.map))
+        magic, version, self.flags, sectionCount, boneCount, sectionsOffset, bonesOffset, animationOffset = self.unpack(HEADER, 0)
+        if (magic != MAGIC):
+            raise FormatError("Not a BP3D binary file")
+        if (version < 1 or version > VERSION):
+            raise FormatError("Unsupported BP3D binary version {}".format(version))
+        streamsOffset = 0
+        instancesOffset = 0
+        if (version >= 2):
+            streamsOffset = self.unpack(HEADER_STREAMS, HEADER.size)[0]
+        if (version >= 3):
+            instancesOffset = self.unpack(HEADER_INSTANCES, HEADER.size + HEADER_STREAMS.size)[0]
+        self.sections = []
+        for i in range(sectionCount):
+            self.sections.append(Section(self, i, self.unpack(SECTION, sectionsOffset + i * SECTION.size)))
+        if (self.flags & FLAG_VERTEX_STREAM):
+            for i, section in enumerate(self.sections):
+                section.stream = VertexStream(self, self.unpack(STREAM, streamsOffset + i * STREAM.size))
+        self.bones = []
+        namesOffset = bonesOffset + boneCount * BONE.size
+        for i in range(boneCount):
+            nameOffset, nameLength, *positions = self.unpack(BONE, bonesOffset + i * BONE.size)
+            with self.block(namesOffset + nameOffset, nameLength) as name:
+                name = bytes(name).decode("utf8")
+            self.bones.append((name, tuple(positions[0:3]), tuple(positions[3:6])))
+        self.animation = None
+        if (self.flags & FLAG_ANIMATION):
+            self.animation = Animation(self, animationOffset)
+        self.instances = None
+        if (self.flags & FLAG_INSTANCES):
+            self.instances = Instances(self, instancesOffset)
+
+    def view(self, view):
+        self.views.append(view)
+        return view
+
+    def block(self, offset, size):
+        if (offset + size > len(self.data)):
+            raise FormatError("Block at {} of {} bytes is past the end of the file".format(offset, size))
+        return self.data[offset:offset + size]
+
+    def unpack(self, layout, offset):
+        with self.block(offset, layout.size) as view:
+            return layout.unpack(view)
+
+    def slice(self, offset, count, fmt):
+        if (count == 0):
+            return array(fmt)
+        if (offset % ALIGNMENT != 0):
+            raise FormatError("Array at {} is not aligned".format(offset))
+        with self.block(offset, count * 4) as view:
+            if (sys.byteorder == "little"):
+                return self.view(view.cast(fmt))
+            copy = array(fmt)
+            copy.frombytes(view)
+        copy.byteswap()
+        return copy
+
+    def validate(self):
+        # Cross checks every index, this walks the whole file
+        for section in self.sections:
+            section.validate(len(self.bones))
+        if (self.animation != None):
+            for boneId in self.animation.tracks:
+                if (boneId < 1 or boneId > len(self.bones)):
+                    raise FormatError("Animation track bone id {} is out of range".format(boneId))
+        if (self.instances != None):
+            self.instances.validate(len(self.sections))
+
+    def close(self):
+        # Arrays handed out by this model must not be used past this point
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        if (self.map != None):
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+def main(fileName):
+    with BinaryModel(fileName) as model:
+        model.validate()
+        print("{}: {} sections, {} bones".format(fileName, len(model.sections), len(model.bones)))
+        for section in model.sections:
+            print("#SubMaterial {}: {} vertices, {} normals, {} uvs, {} faces".format(section.index, len(section.positions) // 3, len(section.normals) // 3, len(section.uvs) // 2, len(section.faceStarts) - 1))
+            if (section.stream != None):
+                print("    vertex stream: {} vertices, {} triangles".format(len(section.stream.vertices) // 8, len(section.stream.indices) // 3))
+        if (model.animation != None):
+            print("Animation: {} frames, {} tracks".format(len(model.animation.frames), len(model.animation.tracks)))
+        if (model.instances != None):
+            print("Instances: {}".format(len(model.instances.sections)))
+
+if __name__ == "__main__":
+    main(sys.argv[1])
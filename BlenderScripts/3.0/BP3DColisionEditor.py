@@ -31,7 +31,13 @@ import math
 import bpy
 import gpu
 from gpu_extras.batch import batch_for_shader
+from bpy_extras.io_utils import ExportHelper
 import bgl
+import collections
+import heapq
+import mathutils
+import time
+import numpy as np
 
 bl_info = {
     "name" : "Colision Editor",
@@ -45,6 +51,361 @@ bl_info = {
 }
 
 MAX_POINTS = 48
+BATCH_CACHE_SIZE = 64
+VOXEL_BATCH = 1 << 20
+
+class HullFace:
+    __slots__ = ("vertices", "normal", "offset", "area", "outside", "farthest", "distance")
+
+class ConvexHull:
+    """Quickhull of a point cloud; with max_points > 0 the hull only grows by the point adding the most volume until it has max_points vertices"""
+    def __init__(self, points, max_points = 0):
+        points = np.ascontiguousarray(np.asarray(points, dtype=np.float64).reshape(-1, 3))
+        # Rows compared as raw bytes, much faster than np.unique with axis=0
+        self.points = points[np.sort(np.unique(points.view(np.dtype((np.void, 24))).ravel(), return_index=True)[1])]
+        self.epsilon = (np.abs(self.points).max() if len(self.points) > 0 else 0.0) * 1e-9
+        self.faces = set()
+        self.edges = {}
+        self.vertices = []
+        self.build(max_points)
+
+    def initial_simplex(self):
+        p = self.points
+        if len(p) < 4:
+            raise ValueError("A convex hull needs at least 4 distinct points")
+        extremes = np.concatenate((p.argmin(axis=0), p.argmax(axis=0)))
+        distances = np.linalg.norm(p[extremes][:, None] - p[extremes][None], axis=2)
+        i, j = np.unravel_index(distances.argmax(), distances.shape)
+        a, b = extremes[i], extremes[j]
+        if distances[i, j] <= self.epsilon:
+            raise ValueError("The points of the convex hull are all the same")
+        direction = (p[b] - p[a]) / distances[i, j]
+        relative = p - p[a]
+        line = np.linalg.norm(relative - np.outer(relative @ direction, direction), axis=1)
+        c = line.argmax()
+        if line[c] <= self.epsilon:
+            raise ValueError("The points of the convex hull are on a line")
+        normal = np.cross(p[b] - p[a], p[c] - p[a])
+        plane = relative @ (normal / np.linalg.norm(normal))
+        d = np.abs(plane).argmax()
+        if abs(plane[d]) <= self.epsilon:
+            raise ValueError("The points of the convex hull are on a plane")
+        return [int(a), int(b), int(c), int(d)]
+
+    def add_face(self, a, b, c):
+        p = self.points
+        face = HullFace()
+        face.vertices = (a, b, c)
+        (ux, uy, uz), (vx, vy, vz) = p[b] - p[a], p[c] - p[a]
+        normal = np.array((uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx))
+        length = np.linalg.norm(normal)
+        face.normal = normal / length if length > 0 else normal
+        face.offset = float(face.normal @ p[a])
+        face.area = length / 2
+        face.outside = np.empty(0, dtype=np.int64)
+        face.farthest = -1
+        face.distance = 0.0
+        self.faces.add(face)
+        for edge in ((a, b), (b, c), (c, a)):
+            self.edges[edge] = face
+        return face
+
+    def remove_face(self, face):
+        a, b, c = face.vertices
+        self.faces.discard(face)
+        for edge in ((a, b), (b, c), (c, a)):
+            if (self.edges.get(edge) is face):
+                del self.edges[edge]
+
+    def assign(self, indices, faces):
+        # Gives every point to the face it is the farthest above, points below all faces are inside the hull
+        if (len(indices) == 0):
+            return
+        normals = np.array([face.normal for face in faces])
+        offsets = np.array([face.offset for face in faces])
+        distances = self.points[indices] @ normals.T - offsets
+        best = distances.argmax(axis=1)
+        outside = distances[np.arange(len(indices)), best] > self.epsilon
+        for k, face in enumerate(faces):
+            mask = outside & (best == k)
+            face.outside = indices[mask]
+            if (len(face.outside) > 0):
+                above = distances[mask, k]
+                face.farthest = int(face.outside[above.argmax()])
+                face.distance = float(above.max())
+
+    def largest_gain(self, pending):
+        # The volume added by a point is the sum of the pyramids it forms with the faces it sees
+        faces = list(self.faces)
+        normals = np.array([face.normal for face in faces])
+        offsets = np.array([face.offset for face in faces])
+        areas = np.array([face.area for face in faces])
+        candidates = self.points[[face.farthest for face in pending]]
+        gains = np.maximum(candidates @ normals.T - offsets, 0.0) @ areas
+        return pending[int(gains.argmax())]
+
+    def add_point(self, face):
+        point = face.farthest
+        position = self.points[point]
+        visible = [face]
+        seen = {face}
+        horizon = []
+        stack = [face]
+        while (len(stack) > 0):
+            current = stack.pop()
+            a, b, c = current.vertices
+            for (v1, v2) in ((a, b), (b, c), (c, a)):
+                neighbour = self.edges[(v2, v1)]
+                if (neighbour in seen):
+                    continue
+                if (neighbour.normal @ position - neighbour.offset > self.epsilon):
+                    seen.add(neighbour)
+                    visible.append(neighbour)
+                    stack.append(neighbour)
+                else:
+                    horizon.append((v1, v2))
+        orphans = np.concatenate([f.outside for f in visible])
+        for f in visible:
+            self.remove_face(f)
+        faces = [self.add_face(v1, v2, point) for (v1, v2) in horizon]
+        self.assign(orphans[orphans != point], faces)
+        self.vertices.append(point)
+        return faces
+
+    def build(self, max_points):
+        a, b, c, d = self.initial_simplex()
+        self.vertices = [a, b, c, d]
+        faces = []
+        for ((v1, v2, v3), opposite) in (((a, b, c), d), ((a, b, d), c), ((a, c, d), b), ((b, c, d), a)):
+            normal = np.cross(self.points[v2] - self.points[v1], self.points[v3] - self.points[v1])
+            if (normal @ (self.points[opposite] - self.points[v1]) > 0):
+                v2, v3 = v3, v2
+            faces.append(self.add_face(v1, v2, v3))
+        self.assign(np.arange(len(self.points)), faces)
+        if (max_points > 0):
+            while (len(self.vertices) < max_points):
+                pending = [face for face in self.faces if len(face.outside) > 0]
+                if (len(pending) == 0):
+                    break
+                self.add_point(self.largest_gain(pending))
+        else:
+            stack = list(faces)
+            while (len(stack) > 0):
+                face = stack.pop()
+                if (face in self.faces and len(face.outside) > 0):
+                    stack.extend(self.add_point(face))
+
+    def mesh(self):
+        """Returns (vertices, triangles) with the triangles counter clockwise seen from outside"""
+        used = sorted(set(v for face in self.faces for v in face.vertices))
+        remap = {v: i for (i, v) in enumerate(used)}
+        triangles = sorted(tuple(remap[v] for v in face.vertices) for face in self.faces)
+        return (self.points[used], triangles)
+
+AXES = {"X": 0, "Y": 1, "Z": 2}
+
+def enclosing_ball(points, iterations = 200, rounds = 4):
+    # Badoiu-Clarkson on a sample: moving the center towards the farthest point by 1/(i+1) converges to the minimal
+    # enclosing ball, the farthest points left outside are then added to the sample and the radius covers every point
+    sample = points[::max(len(points) // 1024, 1)]
+    for _ in range(rounds):
+        center = sample.mean(axis=0)
+        best = (center, np.inf)
+        for i in range(iterations):
+            distances = np.einsum("ij,ij->i", sample - center, sample - center)
+            far = distances.argmax()
+            if (distances[far] < best[1]):
+                best = (center, distances[far])
+            center = center + (sample[far] - center) / (i + 2)
+        center = best[0]
+        distances = np.einsum("ij,ij->i", points - center, points - center)
+        outside = np.flatnonzero(distances > best[1])
+        if (len(outside) == 0):
+            break
+        sample = np.concatenate((sample, points[outside[np.argsort(distances[outside])[-256:]]]))
+    return (center, math.sqrt(distances.max()))
+
+def fit_sphere(points):
+    """Returns (center, radius) of a bounding sphere within a few percent of the smallest one"""
+    return enclosing_ball(points)
+
+def fit_box(points):
+    """Returns (center, half size, rotation quaternion w x y z) of the smaller of the axis aligned and the PCA oriented box"""
+    centered = points - points.mean(axis=0)
+    _, axes = np.linalg.eigh(centered.T @ centered)
+    if (np.linalg.det(axes) < 0):
+        axes[:, 0] = -axes[:, 0]
+    best = None
+    for rotation in (np.identity(3), axes):
+        local = points @ rotation
+        low = local.min(axis=0)
+        high = local.max(axis=0)
+        if (best == None or np.prod(high - low) < best[0]):
+            best = (np.prod(high - low), rotation @ ((low + high) / 2), (high - low) / 2, rotation)
+    quaternion = mathutils.Matrix(best[3].tolist()).to_quaternion()
+    return (best[1], best[2], tuple(quaternion))
+
+def fit_round(points, capsule):
+    # Tries the 3 axes: the radius is the enclosing circle of the points projected along the axis, the height covers the
+    # points along the axis with flat caps for a cylinder and with hemispheres of that radius for a capsule
+    best = None
+    for (orientation, axis) in AXES.items():
+        plane = [i for i in range(3) if i != axis]
+        center, radius = enclosing_ball(points[:, plane])
+        along = points[:, axis]
+        if (capsule):
+            cap = np.sqrt(np.maximum(radius * radius - np.einsum("ij,ij->i", points[:, plane] - center, points[:, plane] - center), 0.0))
+            top = (along - cap).max()
+            bottom = (along + cap).min()
+            height = max((top - bottom) / 2, 0.0)
+            volume = math.pi * radius * radius * (2 * height + 4 / 3 * radius)
+        else:
+            top = along.max()
+            bottom = along.min()
+            height = (top - bottom) / 2
+            volume = math.pi * radius * radius * 2 * height
+        if (best == None or volume < best[0]):
+            position = np.zeros(3)
+            position[plane] = center
+            position[axis] = (top + bottom) / 2
+            best = (volume, position, radius, height, orientation)
+    return best[1:]
+
+def fit_cylinder(points):
+    """Returns (center, radius, half height, orientation) of the smallest bounding cylinder along X, Y or Z"""
+    return fit_round(points, False)
+
+def fit_capsule(points):
+    """Returns (center, radius, half height of the cylinder part, orientation) of the smallest bounding capsule along X, Y or Z"""
+    return fit_round(points, True)
+
+def hull_volume(vertices, triangles):
+    triangles = np.asarray(triangles)
+    if (len(triangles) == 0):
+        return 0.0
+    return float(np.einsum("ij,ij->i", vertices[triangles[:, 0]], np.cross(vertices[triangles[:, 1]], vertices[triangles[:, 2]])).sum() / 6)
+
+def check_deadline(deadline):
+    if (time.perf_counter() > deadline):
+        raise ValueError("Voxelization did not finish within the time budget, lower the resolution or raise the budget")
+
+def mark_surface(surface, points, triangles, low, size, deadline):
+    # Samples every triangle on a barycentric grid finer than half a voxel, triangles needing the same grid are
+    # sampled together in batches of at most VOXEL_BATCH points
+    faces = points[np.asarray(triangles, dtype=np.int64).reshape(-1, 3)]
+    a, b, c = faces[:, 0], faces[:, 1], faces[:, 2]
+    longest = np.maximum(np.maximum(np.linalg.norm(b - a, axis=1), np.linalg.norm(c - b, axis=1)), np.linalg.norm(a - c, axis=1))
+    steps = np.maximum(np.ceil(longest / (size / 2)), 1).astype(np.int64)
+    limit = np.array(surface.shape) - 3
+    for n in np.unique(steps):
+        i, j = np.nonzero(np.add.outer(np.arange(n + 1), np.arange(n + 1)) <= n)
+        u = (i / n)[None, :, None]
+        v = (j / n)[None, :, None]
+        group = np.flatnonzero(steps == n)
+        batch = max(VOXEL_BATCH // len(i), 1)
+        for first in range(0, len(group), batch):
+            check_deadline(deadline)
+            t = group[first:first + batch]
+            samples = a[t][:, None] + u * (b[t] - a[t])[:, None] + v * (c[t] - a[t])[:, None]
+            indices = np.clip(np.floor((samples.reshape(-1, 3) - low) / size).astype(np.int64), 0, limit)
+            surface[indices[:, 0] + 1, indices[:, 1] + 1, indices[:, 2] + 1] = True
+
+def flood_outside(surface, deadline):
+    # Cells reached from the padding without crossing the surface. A run of free cells along an axis is outside as soon
+    # as one of its cells is, sweeping the 3 axes until nothing changes
+    outside = np.zeros_like(surface)
+    outside[0, :, :] = outside[-1, :, :] = outside[:, 0, :] = outside[:, -1, :] = outside[:, :, 0] = outside[:, :, -1] = True
+    outside &= ~surface
+    count = np.count_nonzero(outside)
+    stable = 0
+    while (stable < 3):
+        for axis in range(3):
+            check_deadline(deadline)
+            walls = np.moveaxis(surface, axis, -1)
+            lines = np.arange(walls[..., 0].size, dtype=np.int64).reshape(walls.shape[:-1]) * (walls.shape[-1] + 1)
+            runs = np.cumsum(walls, axis=-1, dtype=np.int64) + lines[..., None]
+            reached = np.zeros(runs[..., -1].max() + 1, dtype=bool)
+            reached[runs[np.moveaxis(outside, axis, -1)]] = True
+            outside = np.moveaxis(reached[runs] & ~walls, -1, axis)
+            total = np.count_nonzero(outside)
+            # A sweep leaves its own axis stable, 3 stable sweeps in a row cover every axis
+            stable = stable + 1 if total == count else 1
+            count = total
+            if (stable >= 3):
+                break
+    return outside
+
+def voxelize(points, triangles, resolution, deadline = math.inf):
+    """Returns (voxel indices, grid origin, voxel size) of the solid voxels of a mesh, an open mesh only gives its surface"""
+    low = points.min(axis=0)
+    size = max((points.max(axis=0) - low).max() / resolution, 1e-9)
+    dims = np.minimum(np.floor((points.max(axis=0) - low) / size).astype(np.int64) + 1, resolution)
+    surface = np.zeros(dims + 2, dtype=bool)
+    mark_surface(surface, points, triangles, low, size, deadline)
+    outside = flood_outside(surface, deadline)
+    return (np.argwhere(~outside[1:-1, 1:-1, 1:-1]), low, size)
+
+def voxel_corners(voxels, low, size):
+    # Only the lowest and highest voxel of each column can hold a vertex of the hull of the voxels
+    voxels = voxels[np.lexsort((voxels[:, 2], voxels[:, 1], voxels[:, 0]))]
+    column = voxels[:, 0] * (voxels[:, 1].max() + 1) + voxels[:, 1]
+    starts = np.flatnonzero(np.concatenate(([True], column[1:] != column[:-1])))
+    ends = np.concatenate((starts[1:], [len(voxels)])) - 1
+    bottom = voxels[starts]
+    top = voxels[ends] + (0, 0, 1)
+    corners = [ends_ + (dx, dy, 0) for ends_ in (bottom, top) for dx in (0, 1) for dy in (0, 1)]
+    return low + np.concatenate(corners) * size
+
+class VoxelPart:
+    """Voxels of a piece of a decomposition with the volume its reduced convex hull adds to them"""
+    def __init__(self, voxels, low, size):
+        self.voxels = voxels
+        self.hull = ConvexHull(voxel_corners(voxels, low, size), MAX_POINTS).mesh()
+        self.concavity = max(hull_volume(*self.hull) - len(voxels) * size ** 3, 0.0)
+
+def best_cut(part, low, size, samples):
+    # Tries samples axis aligned planes per axis, keeping the pair of pieces with the least concavity
+    best = None
+    for axis in range(3):
+        coordinates = part.voxels[:, axis]
+        first = coordinates.min()
+        last = coordinates.max()
+        if (last == first):
+            continue
+        for cut in np.unique(np.linspace(first + 1, last, samples + 2)[1:-1].round().astype(np.int64)):
+            below = coordinates < cut
+            pieces = (VoxelPart(part.voxels[below], low, size), VoxelPart(part.voxels[~below], low, size))
+            concavity = pieces[0].concavity + pieces[1].concavity
+            if (best == None or concavity < best[0]):
+                best = (concavity, pieces)
+    return best[1] if best != None else None
+
+def decompose(points, triangles, max_parts = 8, concavity = 0.01, resolution = 48, time_budget = 10.0, samples = 3):
+    """Splits a mesh into at most max_parts convex hulls of up to MAX_POINTS vertices, returns their (vertices, triangles)
+    concavity is the largest hull volume not covered by the mesh allowed per part, relative to the mesh volume"""
+    deadline = time.perf_counter() + time_budget
+    voxels, low, size = voxelize(points, triangles, resolution, deadline)
+    tolerance = concavity * len(voxels) * size ** 3
+    heap = []
+    count = 0
+    def push(part):
+        nonlocal count
+        heapq.heappush(heap, (-part.concavity, count, part))
+        count += 1
+    push(VoxelPart(voxels, low, size))
+    done = []
+    while (len(heap) > 0 and len(heap) + len(done) < max_parts and time.perf_counter() < deadline):
+        part = heap[0][2]
+        if (part.concavity <= tolerance):
+            break
+        heapq.heappop(heap)
+        pieces = best_cut(part, low, size, samples)
+        if (pieces == None):
+            done.append(part)
+            continue
+        for piece in pieces:
+            push(piece)
+    return [part.hull for part in done + [entry[2] for entry in sorted(heap)]]
 
 class Sphere:
     def __init__(self, radius, rings, sectors):
@@ -201,9 +562,43 @@ class Capsule:
             self.indices.append((l + v1, l + v2, l + v3))
         self.vertices = base.vertices + bottom_vertices + top_vertices
 
+class BatchCache:
+    """GPU batches shared by every gizmo with the same shape key, the least recently used ones are dropped past size"""
+    def __init__(self, size):
+        self.size = size
+        self.batches = collections.OrderedDict()
+
+    def get(self, key, build):
+        batch = self.batches.get(key)
+        if (batch == None):
+            batch = build()
+            self.batches[key] = batch
+            if (len(self.batches) > self.size):
+                self.batches.popitem(last = False)
+        else:
+            self.batches.move_to_end(key)
+        return batch
+
+    def clear(self):
+        self.batches.clear()
+
+def build_shape(key):
+    # key is the type of a unit shape (radius, half height and half size of 1) followed by its orientation and tessellation
+    if key[0] == "Sphere":
+        return Sphere(1.0, key[1], key[1])
+    elif key[0] == "Box":
+        return Box((1.0, 1.0, 1.0))
+    elif key[0] == "Cylinder":
+        return Cylinder(1.0, 1.0, key[2], key[1])
+    elif key[0] == "HalfSphere":
+        return HalfSphere(1.0, key[2], key[2], key[1])
+
 class Renderer:
     def __init__(self):
         self.shader = gpu.shader.from_builtin('3D_UNIFORM_COLOR')
+        self.batches = BatchCache(BATCH_CACHE_SIZE)
+    def get_batch(self, key):
+        return self.batches.get(key, lambda: self.load_mesh(build_shape(key)))
     def load_mesh(self, obj):
         doubled_indices = []
         for (v1, v2, v3) in obj.indices:
@@ -241,7 +636,7 @@ def draw():
                 r.set_red()
             else:
                 r.set_green()
-            component.draw(r)
+            component.draw(r, settings.tessellation)
     r.unlock()
 
 def toggle_view(self, _):
@@ -253,6 +648,17 @@ def toggle_view(self, _):
         draw_handler = None
     return None
 
+def redraw_views(self, context):
+    # Gizmos are drawn from the properties, a change only needs the 3D views to redraw
+    if (context.screen != None):
+        for area in context.screen.areas:
+            if area.type == "VIEW_3D":
+                area.tag_redraw()
+
+def clear_batches(self, context):
+    r.batches.clear()
+    redraw_views(self, context)
+
 class CollisionComponent(bpy.types.PropertyGroup):
     type: bpy.props.EnumProperty(
         items = [
@@ -264,34 +670,48 @@ class CollisionComponent(bpy.types.PropertyGroup):
         ],
         name = "Type",
         default = "Sphere",
-        description = "Collision component type"
+        description = "Collision component type",
+        update = redraw_views
     )
     enabled: bpy.props.BoolProperty(
         name = "Enabled",
         description = "Show in 3D view",
-        default = True
+        default = True,
+        update = redraw_views
     )
     pos: bpy.props.FloatVectorProperty(
         name = "Position",
         subtype = "TRANSLATION",
         description = "Collision component position",
-        default = (0.0, 0.0, 0.0)
+        default = (0.0, 0.0, 0.0),
+        update = redraw_views
     )
     radius: bpy.props.FloatProperty(
         name = "Radius",
         description = "Radius of sphere, cylinder or capsule",
-        default = 1.0
+        default = 1.0,
+        update = redraw_views
     )
     height: bpy.props.FloatProperty(
         name = "Height",
         description = "Height of cylinder or capsule",
-        default = 1.0
+        default = 1.0,
+        update = redraw_views
     )
     size: bpy.props.FloatVectorProperty(
         name = "Size",
         subtype = "XYZ",
         description = "Size of box",
-        default = (1.0, 1.0, 1.0)
+        default = (1.0, 1.0, 1.0),
+        update = redraw_views
+    )
+    rotation: bpy.props.FloatVectorProperty(
+        name = "Rotation",
+        subtype = "QUATERNION",
+        size = 4,
+        description = "Rotation of box",
+        default = (1.0, 0.0, 0.0, 0.0),
+        update = redraw_views
     )
     mesh: bpy.props.StringProperty(
         name = "Mesh name",
@@ -306,28 +726,40 @@ class CollisionComponent(bpy.types.PropertyGroup):
         ],
         name = "Orientation",
         description = "Orientation of capsule or cylinder",
-        default = "Z"
+        default = "Z",
+        update = redraw_views
     )
 
-    gpu_mesh = None
-
-    def get_mesh(self, r):
-        if (self.gpu_mesh == None):
-            if self.type == "Sphere":
-                self.gpu_mesh = r.load_mesh(Sphere(self.radius, 10, 10))
-            elif self.type == "Box":
-                self.gpu_mesh = r.load_mesh(Box(self.size))
-            elif self.type == "Cylinder":
-                self.gpu_mesh = r.load_mesh(Cylinder(self.radius, self.height, 10, self.orientation))
-            elif self.type == "Capsule":
-                self.gpu_mesh = r.load_mesh(Capsule(self.radius, self.height, 10, 10, 10, self.orientation))
-        return self.gpu_mesh
+    def gizmo_parts(self, tessellation):
+        # Unit shapes with the matrix sizing them, a capsule is a cylinder with a hemisphere cap at each end
+        if self.type == "Sphere":
+            return [(("Sphere", tessellation), mathutils.Matrix.Scale(self.radius, 4))]
+        elif self.type == "Box":
+            scale = mathutils.Matrix.Diagonal((*self.size, 1.0))
+            return [(("Box",), mathutils.Quaternion(self.rotation).to_matrix().to_4x4() @ scale)]
+        elif self.type == "Cylinder" or self.type == "Capsule":
+            axis = AXES[self.orientation]
+            scale = [self.radius] * 3 + [1.0]
+            scale[axis] = self.height
+            parts = [(("Cylinder", self.orientation, tessellation), mathutils.Matrix.Diagonal(scale))]
+            if self.type == "Capsule":
+                for side in (1.0, -1.0):
+                    offset = mathutils.Vector((0.0, 0.0, 0.0))
+                    offset[axis] = side * self.height
+                    scale = [self.radius] * 3 + [1.0]
+                    scale[axis] = side * self.radius
+                    parts.append((("HalfSphere", self.orientation, tessellation), mathutils.Matrix.Translation(offset) @ mathutils.Matrix.Diagonal(scale)))
+            return parts
+        return []
 
-    def draw(self, r):
-        mesh = self.get_mesh(r)
+    def draw(self, r, tessellation):
         gpu.matrix.push()
         gpu.matrix.translate(self.pos)
-        r.render(mesh)
+        for (key, matrix) in self.gizmo_parts(tessellation):
+            gpu.matrix.push()
+            gpu.matrix.multiply_matrix(matrix)
+            r.render(r.get_batch(key))
+            gpu.matrix.pop()
         gpu.matrix.pop()
 
 class Settings(bpy.types.PropertyGroup):
@@ -346,6 +778,14 @@ class Settings(bpy.types.PropertyGroup):
         name = "Active component",
         description = "Current active collision component for editing"
     )
+    tessellation: bpy.props.IntProperty(
+        name = "Tessellation",
+        description = "Rings, sectors and points of the round collision gizmos",
+        default = 10,
+        min = 4,
+        max = 64,
+        update = clear_batches
+    )
 
 class COLLISION_UL_component(bpy.types.UIList):
     def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
@@ -371,6 +811,189 @@ class COLLISION_OP_remove(bpy.types.Operator):
         settings.components.remove(index)
         return {'FINISHED'}
 
+def mesh_points(obj, depsgraph):
+    # World space vertices of the evaluated mesh of obj
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        points = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", points)
+    finally:
+        evaluated.to_mesh_clear()
+    matrix = np.array(obj.matrix_world, dtype=np.float64)
+    return points.reshape(-1, 3) @ matrix[0:3, 0:3].T + matrix[0:3, 3]
+
+def mesh_triangles(obj, depsgraph):
+    # World space vertices and triangles of the evaluated mesh of obj
+    evaluated = obj.evaluated_get(depsgraph)
+    mesh = evaluated.to_mesh()
+    try:
+        mesh.calc_loop_triangles()
+        points = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", points)
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+    finally:
+        evaluated.to_mesh_clear()
+    matrix = np.array(obj.matrix_world, dtype=np.float64)
+    return (points.reshape(-1, 3) @ matrix[0:3, 0:3].T + matrix[0:3, 3], triangles.reshape(-1, 3))
+
+def convex_hull(name, depsgraph):
+    obj = bpy.data.objects.get(name)
+    if (obj == None or obj.type != "MESH"):
+        raise ValueError("Convex component mesh '{}' is not a mesh object".format(name))
+    return ConvexHull(mesh_points(obj, depsgraph), MAX_POINTS).mesh()
+
+def export_collision(components, file_name, depsgraph):
+    # Convex hulls are computed once per mesh even when several components use it, and all of them before the file is
+    # opened so that a mesh without a valid hull does not leave a truncated file behind
+    hulls = {}
+    for component in components:
+        if (component.type == "Convex" and component.mesh not in hulls):
+            hulls[component.mesh] = convex_hull(component.mesh, depsgraph)
+    with open(file_name, "w", encoding="utf8", newline="\n") as file:
+        file.write("## BlockProject 3D Collision\n")
+        file.write("#version 1\n")
+        for component in components:
+            pos = "{} {} {}".format(*component.pos)
+            if component.type == "Sphere":
+                file.write("#Sphere {} {}\n".format(pos, component.radius))
+            elif component.type == "Box":
+                file.write("#Box {} {} {} {} {} {} {} {}\n".format(pos, *component.size, *component.rotation))
+            elif component.type == "Cylinder" or component.type == "Capsule":
+                file.write("#{} {} {} {} {}\n".format(component.type, pos, component.radius, component.height, component.orientation))
+            elif component.type == "Convex":
+                vertices, triangles = hulls[component.mesh]
+                # Hull vertices are in world space, the component position does not apply to them
+                file.write("#Convex {} {}\n".format(len(vertices), len(triangles)))
+                for (x, y, z) in vertices:
+                    file.write("v {} {} {}\n".format(x, y, z))
+                for (v1, v2, v3) in triangles:
+                    file.write("f {} {} {}\n".format(v1 + 1, v2 + 1, v3 + 1))
+
+class COLLISION_OP_export(bpy.types.Operator, ExportHelper):
+    bl_label = "Export collision components"
+    bl_idname = "collision.export"
+    filename_ext = ".bp3d.col"
+
+    def execute(self, context):
+        settings = context.scene.bp3d_collision_settings
+        try:
+            export_collision(settings.components, self.filepath, context.evaluated_depsgraph_get())
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+class COLLISION_OP_fit(bpy.types.Operator):
+    bl_label = "Fit collision components"
+    bl_idname = "collision.fit"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    type: bpy.props.EnumProperty(
+        items = [
+            ("Sphere", "Sphere", "Sphere"),
+            ("Box", "Box", "Box"),
+            ("Cylinder", "Cylinder", "Cylinder"),
+            ("Capsule", "Capsule", "Capsule")
+        ],
+        name = "Type",
+        default = "Box",
+        description = "Collision component type fitted to every selected mesh"
+    )
+
+    def execute(self, context):
+        settings = context.scene.bp3d_collision_settings
+        depsgraph = context.evaluated_depsgraph_get()
+        count = 0
+        for obj in context.selected_objects:
+            if (obj.type != "MESH"):
+                continue
+            points = mesh_points(obj, depsgraph)
+            if (len(points) == 0):
+                continue
+            count += 1
+            component = settings.components.add()
+            component.type = self.type
+            if self.type == "Sphere":
+                center, component.radius = fit_sphere(points)
+            elif self.type == "Box":
+                center, component.size, component.rotation = fit_box(points)
+            elif self.type == "Cylinder":
+                center, component.radius, component.height, component.orientation = fit_cylinder(points)
+            elif self.type == "Capsule":
+                center, component.radius, component.height, component.orientation = fit_capsule(points)
+            component.pos = center
+        settings.active_component = len(settings.components) - 1
+        self.report({'INFO'}, "Fitted {} collision components".format(count))
+        return {'FINISHED'}
+
+class COLLISION_OP_decompose(bpy.types.Operator):
+    bl_label = "Convex decomposition"
+    bl_idname = "collision.decompose"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    max_parts: bpy.props.IntProperty(
+        name = "Max parts",
+        description = "Maximum number of convex parts",
+        default = 8,
+        min = 1,
+        max = 64
+    )
+    concavity: bpy.props.FloatProperty(
+        name = "Concavity",
+        description = "Parts are split until the volume their hull adds is below this fraction of the mesh volume",
+        default = 0.01,
+        min = 0.0,
+        max = 1.0
+    )
+    resolution: bpy.props.IntProperty(
+        name = "Resolution",
+        description = "Voxels along the longest side of the mesh",
+        default = 48,
+        min = 8,
+        max = 256
+    )
+    time_budget: bpy.props.FloatProperty(
+        name = "Time budget",
+        description = "Seconds after which no more parts are split",
+        default = 10.0,
+        min = 0.1,
+        subtype = "TIME"
+    )
+
+    def execute(self, context):
+        obj = context.active_object
+        if (obj == None or obj.type != "MESH"):
+            self.report({'ERROR'}, "The active object is not a mesh")
+            return {'CANCELLED'}
+        settings = context.scene.bp3d_collision_settings
+        points, triangles = mesh_triangles(obj, context.evaluated_depsgraph_get())
+        if (len(triangles) == 0):
+            self.report({'ERROR'}, "The active mesh has no faces")
+            return {'CANCELLED'}
+        try:
+            hulls = decompose(points, triangles, self.max_parts, self.concavity, self.resolution, self.time_budget)
+        except ValueError as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        # Every part becomes a hidden wire mesh referenced by a convex component
+        for (i, (vertices, faces)) in enumerate(hulls):
+            mesh = bpy.data.meshes.new("{}.hull.{:03}".format(obj.name, i))
+            mesh.from_pydata(vertices.tolist(), [], faces)
+            mesh.update()
+            part = bpy.data.objects.new(mesh.name, mesh)
+            part.display_type = 'WIRE'
+            part.hide_render = True
+            context.collection.objects.link(part)
+            part.hide_set(True)
+            component = settings.components.add()
+            component.type = "Convex"
+            component.mesh = part.name
+        settings.active_component = len(settings.components) - 1
+        self.report({'INFO'}, "{} split into {} convex parts".format(obj.name, len(hulls)))
+        return {'FINISHED'}
+
 class COLLISION_PT_panel(bpy.types.Panel):
     bl_label = "BP3D Colision Editor"
     bl_category = "BP3D Colision Editor"
@@ -380,6 +1003,7 @@ class COLLISION_PT_panel(bpy.types.Panel):
     def draw(self, context):
         settings = context.scene.bp3d_collision_settings
         self.layout.prop(settings, "enable_view", text="Enable Collision View")
+        self.layout.prop(settings, "tessellation")
         self.layout.separator()
         row = self.layout.row()
         row.label(text = "Collision components: ")
@@ -387,6 +1011,9 @@ class COLLISION_PT_panel(bpy.types.Panel):
         self.layout.template_list("COLLISION_UL_component", "", settings, "components", settings, "active_component")
         self.layout.operator("collision.add", text="Add new component")
         self.layout.operator("collision.remove", text="Remove component")
+        self.layout.operator_menu_enum("collision.fit", "type", text="Fit to selected meshes")
+        self.layout.operator("collision.decompose", text="Decompose active mesh")
+        self.layout.operator("collision.export", text="Export components")
         self.layout.separator()
         if (settings.active_component >= 0 and settings.active_component < len(settings.components)):
             row = self.layout.row()
@@ -408,8 +1035,9 @@ class COLLISION_PT_panel(bpy.types.Panel):
                 row.prop(component, "orientation", text = "")
 
             # Render position
-            col = self.layout.column()
-            col.prop(component, "pos")
+            if component.type != "Convex":
+                col = self.layout.column()
+                col.prop(component, "pos")
 
             # Render radius and height
             if component.type == "Capsule" or component.type == "Cylinder" or component.type == "Sphere":
@@ -421,6 +1049,7 @@ class COLLISION_PT_panel(bpy.types.Panel):
             if component.type == "Box":
                 col = self.layout.column()
                 col.prop(component, "size")
+                col.prop(component, "rotation")
 
             # Render convex mesh name
             if component.type == "Convex":
@@ -431,7 +1060,7 @@ class COLLISION_PT_panel(bpy.types.Panel):
         else:
             self.layout.label(text = "No active component")
 
-CLASS = [CollisionComponent, Settings, COLLISION_OP_add, COLLISION_OP_remove, COLLISION_PT_panel, COLLISION_UL_component]
+CLASS = [CollisionComponent, Settings, COLLISION_OP_add, COLLISION_OP_remove, COLLISION_OP_export, COLLISION_OP_fit, COLLISION_OP_decompose, COLLISION_PT_panel, COLLISION_UL_component]
 
 def register():
     for cl in CLASS:
@@ -39,67 +39,1350 @@ bl_info = {
 
 import bpy
 import bmesh
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
+import hashlib
+import heapq
+import io
+import json
+import math
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import traceback
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
 from bpy.utils import register_class
 from bpy.utils import unregister_class
 from bpy_extras.io_utils import ExportHelper
 
-def getParts(obj): 
-    parts = []
-    parts.append(obj)
-    for o in bpy.data.objects:
-        if o.parent == obj:
-            parts.append(o)
-    return parts
-
-def objectToTriangulatedMesh(obj, context):
-    dg = context.evaluated_depsgraph_get()
-    o1 = obj.evaluated_get(dg)
-    mesh = o1.to_mesh()
-    mat = obj.matrix_world
-    if (mat.determinant() < 0):
-        mesh.flip_normals()
-    bm = bmesh.new()
-    bm.from_mesh(mesh)
-    bmesh.ops.triangulate(bm, faces=bm.faces[:])
-    bmesh.ops.transform(bm, matrix=mat)
-    bm.to_mesh(mesh)
-    bm.free()
-    return (mesh)
-
-def key2d(v):
-    return (v[0], v[1])
-
-def key3d(v):
-    return (v.x, v.y, v.z)
-
-def writeArmatureFile(armature, fileName):
+class Profiler:
+    """Time spent and bytes written in every export stage with item counts per part, saved as name.profile.json"""
+    # Profiler of the running export, stage records nothing when None
+    active = None
+
+    def __init__(self, files):
+        # files are the writers of the export as given to bytesWritten, filled as they are opened
+        self.files = files
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        self.parts = []
+        self.part = None
+        # Largest traced memory seen since the last resetPeakMemory, stages reset the tracemalloc peak
+        self.peak = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # The peak traced memory of the stage is recorded too while tracemalloc is tracing. The peak reached before the
+        # stage is kept in self.peak so that peakMemory still covers it after the reset
+        tracing = tracemalloc.is_tracing()
+        if (tracing):
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        written = bytesWritten(self.files)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            total = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0, "bytes": 0})
+            total["seconds"] += elapsed
+            total["calls"] += 1
+            # With worker processes the bytes of a part land in the stage writing them once formatted
+            total["bytes"] += bytesWritten(self.files) - written
+            if (tracing):
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak = max(self.peak, peak)
+                total["peakBytes"] = max(total.get("peakBytes", 0), peak)
+            if (self.part != None):
+                self.part["stages"][name] = self.part["stages"].get(name, 0.0) + elapsed
+
+    def beginPart(self, name):
+        self.part = {"name": name, "stages": {}, "counts": {}}
+        self.parts.append(self.part)
+
+    def endPart(self):
+        self.part = None
+
+    def count(self, **counts):
+        # Counts of the current part, or of the whole export outside of parts
+        target = self.part["counts"] if self.part != None else self.counts
+        for name, value in counts.items():
+            target[name] = target.get(name, 0) + int(value)
+
+    def save(self, fileName, outputs):
+        report = {
+            "seconds": time.perf_counter() - self.start,
+            "stages": self.stages,
+            "counts": self.counts,
+            "parts": self.parts,
+            "files": {os.path.basename(output): os.path.getsize(output) for output in outputs if os.path.isfile(output)}
+        }
+        with open(fileName, "w") as file:
+            json.dump(report, file, indent=4)
+
+NO_STAGE = contextlib.nullcontext()
+
+def stage(name):
+    # Times the code of a with block as the given stage of the running export
+    if (Profiler.active == None):
+        return NO_STAGE
+    return Profiler.active.stage(name)
+
+def count(**counts):
+    if (Profiler.active != None):
+        Profiler.active.count(**counts)
+
+def resetPeakMemory():
+    tracemalloc.reset_peak()
+    if (Profiler.active != None):
+        Profiler.active.peak = 0
+
+def peakMemory():
+    # Peak traced memory since resetPeakMemory, including the peaks of the profiled stages which reset tracemalloc's
+    peak = tracemalloc.get_traced_memory()[1]
+    if (Profiler.active != None):
+        peak = max(peak, Profiler.active.peak)
+    return peak
+
+def bytesWritten(files):
+    # Bytes written so far to the files of an export, text files count what is still buffered
+    total = 0
+    for file in files:
+        if (isinstance(file, BinaryWriter)):
+            total += file.file.tell()
+        elif (isinstance(file, ObjFile)):
+            total += file.file.written
+            if (file.armFile != None):
+                total += file.armFile.written
+        else:
+            total += file.written
+    return total
+
+def peakResidentMemory():
+    # High water mark of the whole process in bytes, unlike tracemalloc it includes the meshes Blender allocates.
+    # None where the resource module is missing (Windows)
+    if (resource == None):
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Object types objectToTriangulatedMesh can convert
+GEOMETRY_TYPES = {"MESH", "CURVE", "SURFACE", "META", "FONT"}
+# Events let through to the interface during a responsive export
+NAVIGATION_EVENTS = {"MOUSEMOVE", "INBETWEEN_MOUSEMOVE", "MIDDLEMOUSE", "WHEELUPMOUSE", "WHEELDOWNMOUSE", "WHEELINMOUSE", "WHEELOUTMOUSE", "TRACKPADPAN", "TRACKPADZOOM", "MOUSEROTATE", "NDOF_MOTION"}
+
+class Hierarchy:
+    """Parent to children index of the objects of a scene, built once per export"""
+    def __init__(self, objects):
+        # Keyed by name_full, a local object and a linked one may share a name
+        self.children = {}
+        for o in objects:
+            if (o.parent != None):
+                self.children.setdefault(o.parent.name_full, []).append(o)
+        for children in self.children.values():
+            children.sort(key=lambda o: o.name)
+
+    def getParts(self, obj, recursive = True, visibleOnly = False, collection = ""):
+        # The root always comes first, then its descendants depth first in name order. Objects without geometry
+        # or rejected by the filters are not returned but their children are still visited
+        parts = [obj]
+        stack = list(reversed(self.children.get(obj.name_full, [])))
+        while (len(stack) > 0):
+            o = stack.pop()
+            if (o.type in GEOMETRY_TYPES and (not visibleOnly or o.visible_get()) and (collection == "" or collection in [c.name for c in o.users_collection])):
+                parts.append(o)
+            if (recursive):
+                stack.extend(reversed(self.children.get(o.name_full, [])))
+        return parts
+
+def evaluateObject(obj, context):
+    # The mesh belongs to the evaluated object, call to_mesh_clear on it once done with the mesh
+    with stage("evaluate"):
+        dg = context.evaluated_depsgraph_get()
+        o1 = obj.evaluated_get(dg)
+        mesh = o1.to_mesh()
+    count(vertices=len(mesh.vertices), loops=len(mesh.loops), polygons=len(mesh.polygons))
+    return (o1, mesh)
+
+def objectToTriangulatedMesh(obj, context, local = False, evaluated = None):
+    # local keeps the mesh in object space instead of baking the world transform into it. evaluated is the result of
+    # evaluateObject when obj was already evaluated, its mesh is then triangulated in place
+    o1, mesh = evaluated if evaluated != None else evaluateObject(obj, context)
+    with stage("triangulate"):
+        mat = obj.matrix_world
+        if (not local and mat.determinant() < 0):
+            mesh.flip_normals()
+        bm = bmesh.new()
+        bm.from_mesh(mesh)
+        bmesh.ops.triangulate(bm, faces=bm.faces[:])
+        if (not local):
+            bmesh.ops.transform(bm, matrix=mat)
+        bm.to_mesh(mesh)
+        bm.free()
+    # The mesh belongs to the evaluated object, call to_mesh_clear on it once done with the mesh
+    return (o1, mesh)
+
+def objectToLoopTriangles(obj, context, evaluated = None):
+    # Same as objectToTriangulatedMesh without the bmesh round trip, the triangles and the world
+    # transform are applied on the extracted arrays with MeshArrays.useLoopTriangles and MeshArrays.transform
+    o1, mesh = evaluated if evaluated != None else evaluateObject(obj, context)
+    with stage("triangulate"):
+        mesh.calc_loop_triangles()
+    return (o1, mesh)
+
+def modifierSignature(mod):
+    # None when the result of the modifier depends on the transform of other objects, such parts are never instanced
+    settings = []
+    for prop in mod.bl_rna.properties:
+        identifier = prop.identifier
+        # show_* and is_* only drive the interface
+        if (prop.is_readonly or identifier == "name" or identifier.startswith("show_") or identifier.startswith("is_")):
+            continue
+        value = getattr(mod, identifier)
+        if (prop.type == "POINTER"):
+            if (value == None):
+                pass
+            elif (isinstance(value, bpy.types.Object) or isinstance(value, bpy.types.Collection) or not isinstance(value, bpy.types.ID)):
+                return None
+            else:
+                value = value.name_full
+        elif (getattr(prop, "is_array", False)):
+            # The repr of a bpy_prop_array is its data path, which contains the object name
+            value = tuple(value)
+        elif (isinstance(value, set)):
+            value = tuple(sorted(value))
+        settings.append((identifier, repr(value)))
+    return (mod.type, tuple(settings))
+
+def instanceKey(obj):
+    # Parts with the same key evaluate to the same geometry in object space, None when obj cannot be instanced
+    if (obj.type != "MESH"):
+        return None
+    modifiers = []
+    for mod in obj.modifiers:
+        signature = modifierSignature(mod)
+        if (signature == None):
+            return None
+        modifiers.append(signature)
+    return (obj.data.name_full, tuple(vg.name for vg in obj.vertex_groups), tuple(modifiers))
+
+def groupInstances(parts):
+    # Returns a (part, instances) pair per SubMaterial in order of first appearance. instances lists every part
+    # sharing the geometry of part, itself included, or is None when the geometry is not shared
+    groups = {}
+    units = []
+    for part in parts:
+        key = instanceKey(part)
+        if (key != None and key in groups):
+            groups[key].append(part)
+            continue
+        instances = [part]
+        if (key != None):
+            groups[key] = instances
+        units.append((part, instances))
+    return [(part, instances if len(instances) > 1 else None) for part, instances in units]
+
+def instanceTransforms(instances):
+    # World matrix of every instance as 3x4 rows, the last row of an object matrix is always (0, 0, 0, 1)
+    return np.array([np.array(part.matrix_world, dtype=np.float32)[0:3].reshape(-1) for part in instances], dtype=np.float32).reshape(-1, 12)
+
+def uniqueFirstSeen(keys):
+    # np.unique sorts its output, renumber the groups in order of first occurrence so that ids
+    # (and therefore the written tables) are the same as a dict filled while walking the corners
+    if (len(keys) == 0):
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return (first[order], rank[inverse.reshape(-1)])
+
+class MeshArrays:
+    """Flat copies of the mesh data needed to export a part, pulled in bulk with foreach_get"""
+    def __init__(self, mesh):
+        nverts = len(mesh.vertices)
+        nloops = len(mesh.loops)
+        npolys = len(mesh.polygons)
+        self.positions = np.empty(nverts * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", self.positions)
+        self.positions.shape = (nverts, 3)
+        self.normals = np.empty(nloops * 3, dtype=np.float32)
+        mesh.loops.foreach_get("normal", self.normals)
+        self.normals.shape = (nloops, 3)
+        self.loopVertices = np.empty(nloops, dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", self.loopVertices)
+        self.uvs = np.zeros(nloops * 2, dtype=np.float32)
+        if (len(mesh.uv_layers) > 0):
+            mesh.uv_layers.active.data.foreach_get("uv", self.uvs)
+        self.uvs.shape = (nloops, 2)
+        self.loopStarts = np.empty(npolys, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", self.loopStarts)
+        self.loopTotals = np.empty(npolys, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", self.loopTotals)
+        self.triangleLoops = None
+
+    def useLoopTriangles(self, mesh):
+        # Replaces the polygons with the triangles of mesh.loop_triangles
+        self.triangleLoops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("loops", self.triangleLoops)
+        self.loopStarts = np.arange(0, len(self.triangleLoops), 3, dtype=np.int32)
+        self.loopTotals = np.full(len(mesh.loop_triangles), 3, dtype=np.int32)
+
+    def transform(self, matrix):
+        matrix = np.array(matrix, dtype=np.float64)
+        self.positions = (self.positions @ matrix[0:3, 0:3].T + matrix[0:3, 3]).astype(np.float32)
+        normals = self.normals @ np.linalg.inv(matrix[0:3, 0:3])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        np.divide(normals, lengths, out=normals, where=lengths > 0)
+        self.normals = normals.astype(np.float32)
+        if (np.linalg.det(matrix[0:3, 0:3]) < 0 and self.triangleLoops is not None):
+            # A mirroring transform turns the faces inside out, swap 2 corners to restore the winding
+            triangles = self.triangleLoops.reshape(-1, 3)
+            triangles[:, [1, 2]] = triangles[:, [2, 1]]
+
+    def cornerLoops(self):
+        # Loop indices of every face corner in polygon order
+        if (self.triangleLoops is not None):
+            return self.triangleLoops
+        faceStarts = np.zeros(len(self.loopTotals), dtype=np.int64)
+        np.cumsum(self.loopTotals[:-1], out=faceStarts[1:])
+        if (np.array_equal(faceStarts, self.loopStarts)):
+            return np.arange(len(self.normals))
+        total = int(self.loopTotals.sum())
+        return np.repeat(self.loopStarts - faceStarts, self.loopTotals) + np.arange(total)
+
+def weldKeys(values, epsilon):
+    # Snaps values to a grid of epsilon sized cells, values falling in the same cell get the same key
+    if (epsilon > 0):
+        return np.rint(values / epsilon).astype(np.int64)
+    return values.astype(np.float64)
+
+def countUnique(keys):
+    if (len(keys) == 0):
+        return 0
+    return len(np.unique(keys, axis=0))
+
+class PartData:
+    """Vertex, normal and UV tables of a part with the face corners indexing them (all ids are 0 based)"""
+    def __init__(self, arrays, normalWeld = 0.0, uvWeld = 0.0):
+        loops = arrays.cornerLoops()
+        normals = arrays.normals[loops]
+        uvs = arrays.uvs[loops]
+        vertices = arrays.loopVertices[loops]
+        with stage("normals"):
+            normalFirst, normalIds = uniqueFirstSeen(weldKeys(normals, normalWeld))
+        with stage("uvs"):
+            # UVs are only shared between corners of the same vertex
+            uvKeys = np.column_stack((vertices, weldKeys(uvs, uvWeld)))
+            uvFirst, uvIds = uniqueFirstSeen(uvKeys)
+        self.positions = arrays.positions
+        self.normals = normals[normalFirst]
+        self.uvs = uvs[uvFirst]
+        self.corners = np.column_stack((vertices, uvIds, normalIds)).astype(np.int64)
+        self.faceStarts = np.zeros(len(arrays.loopTotals) + 1, dtype=np.int64)
+        np.cumsum(arrays.loopTotals, out=self.faceStarts[1:])
+        # Number of entries that would have been written without welding but were merged
+        self.weldedNormals = 0
+        self.weldedUvs = 0
+        if (normalWeld > 0):
+            self.weldedNormals = countUnique(normals) - len(self.normals)
+        if (uvWeld > 0):
+            self.weldedUvs = countUnique(np.column_stack((vertices, uvs.astype(np.float64)))) - len(self.uvs)
+
+    @staticmethod
+    def fromTables(positions, normals, uvs, corners, faceStarts):
+        data = PartData.__new__(PartData)
+        data.positions = positions
+        data.normals = normals
+        data.uvs = uvs
+        data.corners = corners
+        data.faceStarts = faceStarts
+        data.weldedNormals = 0
+        data.weldedUvs = 0
+        return data
+
+    def isTriangulated(self):
+        return len(self.corners) > 0 and not np.any(np.diff(self.faceStarts) != 3)
+
+    def compact(self):
+        # Drops the vertices, uvs and normals no face uses and orders the rest by first use, returns the kept vertices
+        order, remap = compactTable(self.corners[:, 0], len(self.positions))
+        self.positions = self.positions[order]
+        self.corners[:, 0] = remap[self.corners[:, 0]]
+        uvOrder, remap = compactTable(self.corners[:, 1], len(self.uvs))
+        self.uvs = self.uvs[uvOrder]
+        self.corners[:, 1] = remap[self.corners[:, 1]]
+        normalOrder, remap = compactTable(self.corners[:, 2], len(self.normals))
+        self.normals = self.normals[normalOrder]
+        self.corners[:, 2] = remap[self.corners[:, 2]]
+        return order
+
+    def optimizeVertexCache(self, cacheSize):
+        # Reorders the triangles for the post transform cache then the vertex, uv and normal tables by first use.
+        # Returns the cache statistics before and after and the new order of the vertices, None if not triangulated
+        if (not self.isTriangulated()):
+            return None
+        _, unified = uniqueFirstSeen(self.corners)
+        vertexCount = int(unified.max()) + 1
+        before = vertexCacheStats(unified, vertexCount, cacheSize)
+        triangles = forsythOrder(unified, vertexCount, cacheSize)
+        after = vertexCacheStats(unified.reshape(-1, 3)[triangles].reshape(-1), vertexCount, cacheSize)
+        self.corners = self.corners.reshape(-1, 3, 3)[triangles].reshape(-1, 3)
+        order, remap = firstUseOrder(self.corners[:, 0], len(self.positions))
+        self.positions = self.positions[order]
+        self.corners[:, 0] = remap[self.corners[:, 0]]
+        uvOrder, remap = firstUseOrder(self.corners[:, 1], len(self.uvs))
+        self.uvs = self.uvs[uvOrder]
+        self.corners[:, 1] = remap[self.corners[:, 1]]
+        normalOrder, remap = firstUseOrder(self.corners[:, 2], len(self.normals))
+        self.normals = self.normals[normalOrder]
+        self.corners[:, 2] = remap[self.corners[:, 2]]
+        return (before, after, order)
+
+def compactTable(ids, count):
+    # Same as firstUseOrder but the order only lists the used entries
+    order, remap = firstUseOrder(ids, count)
+    return (order[0:np.count_nonzero(np.bincount(ids, minlength=count))], remap)
+
+class Simplifier:
+    """Quadric error metric edge collapse (Garland & Heckbert) restricted to half edge collapses so vertices never
+    move. Vertices on borders and UV or normal seams are never removed and vertices only collapse onto vertices with
+    the same dominant bone, which keeps seams, normal discontinuities and bone weight boundaries in place"""
+    def __init__(self, data, skin):
+        corners = data.corners.reshape(-1, 3, 3)
+        tris = corners[:, :, 0]
+        vertexCount = len(data.positions)
+        positions = data.positions.astype(np.float64)
+        points = positions[tris]
+        normals = np.cross(points[:, 1] - points[:, 0], points[:, 2] - points[:, 0])
+        areas = np.linalg.norm(normals, axis=1)
+        normals /= np.maximum(areas, 1e-30)[:, None]
+        planes = np.column_stack((normals, -np.einsum("ij,ij->i", normals, points[:, 0])))
+        faceQuadrics = planes[:, :, None] * planes[:, None, :] * (areas / 2)[:, None, None]
+        self.quadrics = np.zeros((vertexCount, 4, 4))
+        for k in range(3):
+            np.add.at(self.quadrics, tris[:, k], faceQuadrics)
+        self.points = positions.tolist()
+        edges = np.sort(np.concatenate((tris[:, [0, 1]], tris[:, [1, 2]], tris[:, [2, 0]])), axis=1)
+        edges, uses = np.unique(edges, axis=0, return_counts=True)
+        locked = np.zeros(vertexCount, dtype=bool)
+        locked[edges[uses != 2].reshape(-1)] = True
+        locked |= np.bincount(np.unique(data.corners, axis=0)[:, 0], minlength=vertexCount) > 1
+        self.locked = locked.tolist()
+        bones = np.zeros(vertexCount, dtype=np.int64)
+        if (skin != None):
+            # The influences of a vertex sorted by weight, the last one is the dominant bone
+            counts = np.diff(skin.starts)
+            order = np.lexsort((skin.weights, np.repeat(np.arange(vertexCount), counts)))
+            bones[counts > 0] = skin.boneIds[order[skin.starts[1:][counts > 0] - 1]]
+        self.bones = bones.tolist()
+        self.tris = tris.tolist()
+        self.wedges = [[tuple(wedge) for wedge in tri] for tri in corners[:, :, 1:].tolist()]
+        self.adjacency = [set() for _ in range(vertexCount)]
+        for t, tri in enumerate(self.tris):
+            for v in tri:
+                self.adjacency[v].add(t)
+        self.alive = [True] * len(self.tris)
+        self.triangleCount = len(self.tris)
+        self.stamps = [0] * vertexCount
+        self.positions = positions
+        # Every edge in both directions, costed in one pass and heapified at once
+        pairs = np.concatenate((edges, edges[:, ::-1]))
+        pairs = pairs[~locked[pairs[:, 0]] & (bones[pairs[:, 0]] == bones[pairs[:, 1]])]
+        self.heap = [(cost, u, v, 0, 0) for cost, (u, v) in zip(self.costs(pairs).tolist(), pairs.tolist())]
+        heapq.heapify(self.heap)
+
+    def costs(self, pairs):
+        # Quadric error of collapsing u onto v for every (u, v) row of pairs
+        h = np.column_stack((self.positions[pairs[:, 1]], np.ones(len(pairs))))
+        return np.maximum(np.einsum("ij,ijk,ik->i", h, self.quadrics[pairs[:, 0]] + self.quadrics[pairs[:, 1]], h), 0.0)
+
+    def push(self, pairs):
+        # Queues the collapses of u onto v for every (u, v) of pairs
+        pairs = [(u, v) for (u, v) in pairs if not self.locked[u] and self.bones[u] == self.bones[v]]
+        if (len(pairs) == 0):
+            return
+        for cost, (u, v) in zip(self.costs(np.array(pairs)).tolist(), pairs):
+            heapq.heappush(self.heap, (cost, u, v, self.stamps[u], self.stamps[v]))
+
+    def neighbors(self, v):
+        return {w for t in self.adjacency[v] for w in self.tris[t]} - {v}
+
+    def collapseWedge(self, u, v):
+        # Returns the uv and normal the corners of u take once moved onto v, None if the collapse is not allowed
+        shared = [t for t in self.adjacency[u] if v in self.tris[t]]
+        if (len(shared) != 2):
+            return None
+        wedges = {self.wedges[t][self.tris[t].index(v)] for t in shared}
+        if (len(wedges) != 1 or len(self.neighbors(u) & self.neighbors(v)) != 2):
+            return None
+        pv = self.points[v]
+        for t in self.adjacency[u]:
+            if (t in shared):
+                continue
+            a, b, c = [self.points[w] for w in self.tris[t]]
+            before = cross(a, b, c)
+            a, b, c = [pv if w == u else self.points[w] for w in self.tris[t]]
+            after = cross(a, b, c)
+            # Refuse collapses flipping, degenerating or folding a triangle by more than ~75 degrees
+            dot = before[0] * after[0] + before[1] * after[1] + before[2] * after[2]
+            if (dot <= 0.25 * math.sqrt((before[0] ** 2 + before[1] ** 2 + before[2] ** 2) * (after[0] ** 2 + after[1] ** 2 + after[2] ** 2))):
+                return None
+        return wedges.pop()
+
+    def collapse(self, u, v, wedge):
+        for t in self.adjacency[u]:
+            tri = self.tris[t]
+            if (v in tri):
+                self.alive[t] = False
+                self.triangleCount -= 1
+                for w in tri:
+                    if (w != u):
+                        self.adjacency[w].discard(t)
+            else:
+                i = tri.index(u)
+                tri[i] = v
+                self.wedges[t][i] = wedge
+                self.adjacency[v].add(t)
+        self.adjacency[u] = set()
+        self.quadrics[v] += self.quadrics[u]
+        self.stamps[u] += 1
+        self.stamps[v] += 1
+        neighbors = self.neighbors(v)
+        self.push([(v, w) for w in neighbors] + [(w, v) for w in neighbors])
+
+    def run(self, targetTriangles):
+        # Collapses edges by increasing error until targetTriangles is reached, returns the largest error accepted
+        maxError = 0.0
+        while (self.triangleCount > targetTriangles and len(self.heap) > 0):
+            cost, u, v, stampU, stampV = heapq.heappop(self.heap)
+            if (stampU != self.stamps[u] or stampV != self.stamps[v]):
+                continue
+            wedge = self.collapseWedge(u, v)
+            if (wedge is None):
+                continue
+            self.collapse(u, v, wedge)
+            maxError = max(maxError, cost)
+        return maxError
+
+    def result(self, data):
+        # Returns the simplified copy of data and the vertices of data it kept
+        corners = [(tri[i], *wedge[i]) for tri, wedge, alive in zip(self.tris, self.wedges, self.alive) if alive for i in range(3)]
+        lod = copy.copy(data)
+        lod.corners = np.array(corners, dtype=np.int64).reshape(-1, 3)
+        lod.faceStarts = np.arange(0, len(lod.corners) + 1, 3, dtype=np.int64)
+        return (lod, lod.compact())
+
+def cross(a, b, c):
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+
+def gatherRanges(starts, order):
+    # Concatenates the ranges starts[i]:starts[i + 1] for every i in order, returns the new starts and the gathered indices
+    counts = np.diff(starts)[order]
+    newStarts = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(counts, out=newStarts[1:])
+    return (newStarts, np.repeat(starts[order] - newStarts[:-1], counts) + np.arange(newStarts[-1]))
+
+class VertexStream:
+    """Face corners of a part welded into unique (position, normal, uv) vertices, ready for upload as an
+    interleaved vertex buffer (position x3, normal x3, uv x2) and a triangle index buffer"""
+    def __init__(self, data, skin):
+        first, self.indices = uniqueFirstSeen(data.corners)
+        unique = data.corners[first]
+        self.vertices = np.empty((len(first), 8), dtype=np.float32)
+        self.vertices[:, 0:3] = data.positions[unique[:, 0]]
+        self.vertices[:, 3:6] = data.normals[unique[:, 2]]
+        self.vertices[:, 6:8] = data.uvs[unique[:, 1]]
+        self.starts = None
+        self.boneIds = None
+        self.weights = None
+        if (skin != None):
+            # Every vertex takes the influences of its position
+            self.starts, influences = gatherRanges(skin.starts, unique[:, 0])
+            self.boneIds = skin.boneIds[influences]
+            self.weights = skin.weights[influences]
+
+FORSYTH_CACHE_DECAY_POWER = 1.5
+FORSYTH_LAST_TRI_SCORE = 0.75
+FORSYTH_VALENCE_BOOST_SCALE = 2.0
+FORSYTH_VALENCE_BOOST_POWER = 0.5
+
+def forsythScore(cachePos, remaining, cacheSize):
+    if (remaining == 0):
+        return -1.0
+    score = 0.0
+    if (cachePos >= 0):
+        if (cachePos < 3):
+            # The vertices of the last triangle get a fixed score to avoid sticking to the same strip
+            score = FORSYTH_LAST_TRI_SCORE
+        else:
+            score = (1.0 - (cachePos - 3) / (cacheSize - 3)) ** FORSYTH_CACHE_DECAY_POWER
+    return score + FORSYTH_VALENCE_BOOST_SCALE * remaining ** -FORSYTH_VALENCE_BOOST_POWER
+
+def forsythOrder(indices, vertexCount, cacheSize):
+    # Tom Forsyth's linear speed vertex cache optimisation, returns the new order of the triangles of the index buffer
+    triangleCount = len(indices) // 3
+    tris = indices.reshape(-1, 3).tolist()
+    valence = np.bincount(indices, minlength=vertexCount)
+    adjStarts = np.zeros(vertexCount + 1, dtype=np.int64)
+    np.cumsum(valence, out=adjStarts[1:])
+    adjTris = (np.argsort(indices, kind="stable") // 3).tolist()
+    adjStarts = adjStarts.tolist()
+    adjacency = [adjTris[adjStarts[v]:adjStarts[v + 1]] for v in range(vertexCount)]
+    remaining = valence.tolist()
+    cachePos = [-1] * vertexCount
+    vertexScores = [forsythScore(-1, r, cacheSize) for r in remaining]
+    triScores = [vertexScores[a] + vertexScores[b] + vertexScores[c] for a, b, c in tris]
+    added = bytearray(triangleCount)
+    cache = []
+    order = []
+    best = max(range(triangleCount), key=triScores.__getitem__, default=-1)
+    scan = 0
+    while (len(order) < triangleCount):
+        if (best < 0):
+            # Nothing left around the cache, continue with the first triangle not yet emitted
+            while (added[scan]):
+                scan += 1
+            best = scan
+        added[best] = 1
+        order.append(best)
+        tri = tris[best]
+        for v in tri:
+            adjacency[v].remove(best)
+            remaining[v] -= 1
+        newCache = tri + [v for v in cache if v not in tri]
+        for v in newCache[cacheSize:]:
+            cachePos[v] = -1
+        cache = newCache[0:cacheSize]
+        for i, v in enumerate(cache):
+            cachePos[v] = i
+        best = -1
+        bestScore = -1.0
+        for v in newCache:
+            score = forsythScore(cachePos[v], remaining[v], cacheSize)
+            delta = score - vertexScores[v]
+            vertexScores[v] = score
+            for t in adjacency[v]:
+                triScores[t] += delta
+        for v in cache:
+            for t in adjacency[v]:
+                if (triScores[t] > bestScore):
+                    best = t
+                    bestScore = triScores[t]
+    return np.array(order, dtype=np.int64)
+
+def vertexCacheStats(indices, vertexCount, cacheSize):
+    # Simulates a FIFO post transform cache, returns the ACMR (misses per triangle) and ATVR (misses per vertex)
+    stamps = [-cacheSize] * vertexCount
+    misses = 0
+    for v in indices.tolist():
+        if (misses - stamps[v] >= cacheSize):
+            stamps[v] = misses
+            misses += 1
+    return (misses / max(len(indices) // 3, 1), misses / max(vertexCount, 1))
+
+def firstUseOrder(ids, count):
+    # Orders the entries of a table by first use in ids (unused entries go last), returns the order and the id remap
+    first = np.full(count, len(ids), dtype=np.int64)
+    np.minimum.at(first, ids, np.arange(len(ids)))
+    order = np.argsort(first, kind="stable")
+    remap = np.empty(count, dtype=np.int64)
+    remap[order] = np.arange(count)
+    return (order, remap)
+
+# Number of buffered characters after which a TextWriter hands its content to the file
+BUFFER_SIZE = 1 << 20
+
+class TextWriter:
+    """Buffered text file writer formatting whole blocks of rows with a single str.format call"""
+    def __init__(self, fileName, chunkSize):
+        self.file = open(fileName, "w", encoding="utf8", newline="\n")
+        self.fileName = fileName
+        self.chunkSize = chunkSize
+        self.buffer = []
+        self.size = 0
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        self.written += len(text)
+        if (self.size >= BUFFER_SIZE):
+            self.flush()
+
+    def writeRows(self, fmt, rows):
+        # fmt is the format of a single row, rows is a 2D array or a list of tuples matching it
+        width = fmt.count("{}")
+        if (hasattr(rows, "tolist")):
+            values = rows.reshape(-1).tolist()
+        else:
+            values = [v for row in rows for v in row]
+        step = self.chunkSize * width
+        block = fmt * self.chunkSize
+        for i in range(0, len(values), step):
+            chunk = values[i:i + step]
+            if (len(chunk) < step):
+                block = fmt * (len(chunk) // width)
+            self.write(block.format(*chunk))
+
+    def writeLines(self, lines):
+        for i in range(0, len(lines), self.chunkSize):
+            self.write("".join(lines[i:i + self.chunkSize]))
+
+    def flush(self):
+        self.file.write("".join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class TextBuffer(TextWriter):
+    """TextWriter collecting the text in memory"""
+    def __init__(self, chunkSize):
+        self.file = io.StringIO()
+        self.chunkSize = chunkSize
+        self.buffer = []
+        self.size = 0
+        self.written = 0
+
+    def getValue(self):
+        self.flush()
+        return self.file.getvalue()
+
+def writeFaces(writer, corners, faceStarts):
+    sizes = np.diff(faceStarts)
+    # Runs of faces with the same number of corners are written as fixed width rows
+    runs = np.concatenate(([0], np.flatnonzero(np.diff(sizes)) + 1, [len(sizes)])).tolist()
+    for first, last in zip(runs[:-1], runs[1:]):
+        if (first == last):
+            continue
+        size = int(sizes[first])
+        rows = corners[faceStarts[first]:faceStarts[last]].reshape(last - first, 3 * size)
+        writer.writeRows("f" + " {}/{}/{}" * size + "\n", rows)
+
+class SkinData:
+    """Bone influences of every vertex of a part: the influences of vertex i are starts[i]:starts[i + 1]"""
+    def __init__(self, mesh, part, boneMap, maxInfluences = 0, minWeight = 0.0):
+        # Vertex groups are resolved to bone ids once, the ones which are not bones map to 0 and are dropped
+        table = np.array([boneMap.get(group.name, 0) for group in part.vertex_groups], dtype=np.int32)
+        groups = [v.groups for v in mesh.vertices]
+        self.starts = np.zeros(len(groups) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(g) for g in groups), dtype=np.int64, count=len(groups)), out=self.starts[1:])
+        influences = np.array([(group.group, group.weight) for g in groups for group in g], dtype=np.float64).reshape(-1, 2)
+        groups = None
+        self.boneIds = table[influences[:, 0].astype(np.int64)]
+        self.weights = influences[:, 1].astype(np.float32)
+        influences = None
+        self.select(self.boneIds != 0)
+        if (maxInfluences > 0 or minWeight > 0):
+            self.limit(maxInfluences, minWeight)
+
+    @staticmethod
+    def fromTables(starts, boneIds, weights):
+        skin = SkinData.__new__(SkinData)
+        skin.starts = starts
+        skin.boneIds = boneIds
+        skin.weights = weights
+        return skin
+
+    def reorder(self, order):
+        self.starts, influences = gatherRanges(self.starts, order)
+        self.boneIds = self.boneIds[influences]
+        self.weights = self.weights[influences]
+
+    def vertices(self):
+        # Vertex of every influence
+        return np.repeat(np.arange(len(self.starts) - 1), np.diff(self.starts))
+
+    def select(self, mask):
+        self.starts = np.concatenate(([0], np.cumsum(np.bincount(self.vertices()[mask], minlength=len(self.starts) - 1))))
+        self.boneIds = self.boneIds[mask]
+        self.weights = self.weights[mask]
+
+    def limit(self, maxInfluences, minWeight):
+        # Keeps the maxInfluences (0 for all) heaviest influences of every vertex, drops the ones under minWeight
+        # except the heaviest and normalizes the weights of every vertex to a sum of 1. Influences end up sorted
+        # by decreasing weight
+        vertices = self.vertices()
+        order = np.lexsort((-self.weights, vertices))
+        self.boneIds = self.boneIds[order]
+        self.weights = self.weights[order]
+        rank = np.arange(len(order)) - self.starts[vertices]
+        keep = (rank == 0) | (self.weights >= minWeight)
+        if (maxInfluences > 0):
+            keep &= rank < maxInfluences
+        self.select(keep)
+        vertices = self.vertices()
+        sums = np.bincount(vertices, self.weights, minlength=len(self.starts) - 1)
+        self.weights = (self.weights / np.where(sums > 0, sums, 1)[vertices]).astype(np.float32)
+
+    def padded(self, width):
+        # Copy with exactly width influences per vertex (the largest influence count when 0), the missing ones
+        # use bone id 0 with a weight of 0
+        vertexCount = len(self.starts) - 1
+        counts = np.diff(self.starts)
+        width = max(width, int(counts.max()) if vertexCount > 0 else 0)
+        vertices = self.vertices()
+        rank = np.arange(len(vertices)) - self.starts[vertices]
+        boneIds = np.zeros((vertexCount, width), dtype=np.int32)
+        weights = np.zeros((vertexCount, width), dtype=np.float32)
+        boneIds[vertices, rank] = self.boneIds
+        weights[vertices, rank] = self.weights
+        return SkinData.fromTables(np.arange(vertexCount + 1, dtype=np.int64) * width, boneIds.reshape(-1), weights.reshape(-1))
+
+def writeSkin(writer, skin):
+    starts = skin.starts.tolist()
+    boneIds = skin.boneIds.tolist()
+    weights = skin.weights.tolist()
+    formats = {}
+    lines = []
+    for i in range(len(starts) - 1):
+        first = starts[i]
+        last = starts[i + 1]
+        fmt = formats.get(last - first)
+        if (fmt is None):
+            fmt = "vb" + " {}" * (last - first) + "\nvw" + " {}" * (last - first) + "\n"
+            formats[last - first] = fmt
+        lines.append(fmt.format(*boneIds[first:last], *weights[first:last]))
+    writer.writeLines(lines)
+
+def writeArmatureFile(armature, fileName, chunkSize):
     fileName = fileName[0:len(fileName) - len(".bp3d.obj")] + ".armature.bp3d.obj"
     boneMap = {}
     count = 1
-    file = open(fileName, "w", encoding="utf8", newline="\n")
+    file = TextWriter(fileName, chunkSize)
     file.write("## BlockProject 3D Object Armature\n")
     file.write("\n")
     for bone in armature.bones:
-        # The "bone" command takes bone name, bone head position x3 and bone tail position x3
-        file.write("bone {} {} {} {} {} {} {}\n".format(bone.name, bone.head[0], bone.head[1], bone.head[2], bone.tail[0], bone.tail[1], bone.tail[2]))
         boneMap[bone.name] = count
         count += 1
+    # The "bone" command takes bone name, bone head position x3 and bone tail position x3
+    file.writeRows("bone {} {} {} {} {} {} {}\n", [(bone.name, *bone.head[0:3], *bone.tail[0:3]) for bone in armature.bones])
     return (boneMap, file)
 
-def writeAnimationFile(scene, boneMap, armatureWeird, fileName):
-    fileName = fileName[0:len(fileName) - len(".bp3d.obj")] + ".animation.bp3d.obj"
-    with open(fileName, "w", encoding="utf8", newline="\n") as file:
-        file.write("## BlockProject 3D Object Animation\n")
-        file.write("\n")
-        for f in range(scene.frame_start, scene.frame_end + 1):
+def writeSection(writer, data, offsets, useMultiMaterial):
+    sd, vcount, uvcount, ncount = offsets
+    writer.write("\n")
+    #SubMaterial (index of sub material, number to subtract to vertex id, number to subtract to uv id, number to subtract to normal id)
+    if (useMultiMaterial):
+        writer.write("#SubMaterial {} {} {} {}\n".format(sd, vcount, uvcount, ncount))
+    writer.write("## Vertices\n")
+    writer.writeRows("v {} {} {}\n", data.positions)
+    writer.write("## Normals\n")
+    writer.writeRows("vn {} {} {}\n", data.normals)
+    writer.write("## UVs\n")
+    writer.writeRows("vt {} {}\n", data.uvs)
+    writer.write("## Faces\n")
+    writeFaces(writer, data.corners + (vcount, uvcount, ncount), data.faceStarts)
+
+def writeInstances(writer, transforms):
+    writer.write("## Instances\n")
+    writer.writeRows("#Instance {} {} {} {} {} {} {} {} {} {} {} {}\n", transforms)
+
+# formatSection and formatSkin also run in the worker processes, they must not use bpy
+def formatSection(data, offsets, useMultiMaterial, chunkSize):
+    buffer = TextBuffer(chunkSize)
+    writeSection(buffer, data, offsets, useMultiMaterial)
+    return buffer.getValue()
+
+def formatSkin(skin, chunkSize):
+    buffer = TextBuffer(chunkSize)
+    writeSkin(buffer, skin)
+    return buffer.getValue()
+
+def createPool(workers):
+    # Workers are forked so that they inherit this module, a spawned interpreter would have to import it without bpy.
+    # Forking a multithreaded GUI process like Blender can crash or hang on macOS, so the pool is only used on Linux
+    if (workers <= 1):
+        return None
+    if (not sys.platform.startswith("linux")):
+        print("BP3D OBJ worker processes are only supported on Linux, parts are formatted on the main thread")
+        return None
+    return concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+
+class ObjFile:
+    """A .bp3d.obj file being written part by part, together with its .armature.bp3d.obj when rigged. With a pool the
+    sections are formatted by the workers and queued, they are written in order as they complete"""
+    def __init__(self, fileName, chunkSize, partCount, armature, instancing = False, pool = None, queueSize = 0):
+        self.pool = pool
+        self.pending = collections.deque()
+        self.limit = queueSize
+        self.boneMap = None
+        self.armFile = None
+        if (armature != None):
+            self.boneMap, self.armFile = writeArmatureFile(armature, fileName, chunkSize)
+        self.file = TextWriter(fileName, chunkSize)
+        self.file.write("## BlockProject 3D Object\n")
+        self.file.write("#version 1\n")
+        if (armature != None):
+            self.file.write("#use ArmatureAnimation")
+        self.useMultiMaterial = False
+        if (partCount > 1):
+            self.useMultiMaterial = True
+            self.file.write("#use MultiMaterial\n")
+            self.file.write("#AllocMat {}\n".format(partCount))
+        if (instancing):
+            self.file.write("#use Instancing\n")
+        self.file.write("\n")
+        self.sd = 0
+        self.vcount = 1
+        self.ncount = 1
+        self.uvcount = 1
+
+    def fileNames(self):
+        names = [self.file.fileName]
+        if (self.armFile != None):
+            names.append(self.armFile.fileName)
+        return names
+
+    def offsets(self):
+        return (self.sd, self.vcount, self.uvcount, self.ncount)
+
+    def layout(self):
+        # Everything the text of the next section depends on besides the part itself
+        return (*self.offsets(), self.useMultiMaterial)
+
+    def formatPart(self, data):
+        # Returns the text writePart would write for data at the current offsets, or with a pool the future of the
+        # worker formatting it
+        if (self.pool != None):
+            return self.pool.submit(formatSection, data, self.offsets(), self.useMultiMaterial, self.file.chunkSize)
+        return formatSection(data, self.offsets(), self.useMultiMaterial, self.file.chunkSize)
+
+    def write(self, text):
+        if (self.pool != None):
+            self.queue(self.file, text)
+        else:
+            self.file.write(text)
+
+    def writePart(self, data, skin, text = None, transforms = None):
+        # text is the section as returned by formatPart, it is formatted from data when not given. transforms
+        # holds the 3x4 world matrix of each instance when data is an object space geometry shared by several parts
+        if (self.pool != None):
+            if (text == None):
+                text = self.pool.submit(formatSection, data, self.offsets(), self.useMultiMaterial, self.file.chunkSize)
+            self.queue(self.file, text)
+            if (transforms is not None):
+                buffer = TextBuffer(self.file.chunkSize)
+                writeInstances(buffer, transforms)
+                self.queue(self.file, buffer.getValue())
+            if (skin != None):
+                self.queue(self.armFile, self.pool.submit(formatSkin, skin, self.file.chunkSize))
+        else:
+            if (text != None):
+                self.file.write(text)
+            else:
+                writeSection(self.file, data, self.offsets(), self.useMultiMaterial)
+            if (transforms is not None):
+                writeInstances(self.file, transforms)
+            if (skin != None):
+                writeSkin(self.armFile, skin)
+        self.vcount += len(data.positions)
+        self.uvcount += len(data.uvs)
+        self.ncount += len(data.normals)
+        self.sd += 1
+
+    def queue(self, writer, item):
+        # item is the text to write or the future of a worker formatting it
+        self.pending.append((writer, item))
+        self.drain(self.limit)
+
+    def drain(self, limit):
+        # Writes the queued items in order, waiting on the workers while more than limit items are queued
+        while (len(self.pending) > 0):
+            writer, item = self.pending[0]
+            if (isinstance(item, concurrent.futures.Future)):
+                if (len(self.pending) <= limit and not item.done()):
+                    break
+                item = item.result()
+            writer.write(item)
+            self.pending.popleft()
+
+    def flush(self):
+        self.drain(0)
+        self.file.flush()
+        if (self.armFile != None):
+            self.armFile.flush()
+
+    def close(self):
+        self.drain(0)
+        self.file.close()
+        if (self.armFile != None):
+            self.armFile.close()
+
+# Pose bone channels written for every frame and track, in order
+ANIMATION_CHANNELS = (("location", 3), ("scale", 3), ("rotation_quaternion", 4))
+
+def sampleCurves(armatureWeird, frames):
+    # Evaluates the F-curves of the active action for every pose bone channel, channels without a curve keep their
+    # current value. Returns None when drivers or the NLA also write the channels, only a full scene evaluation
+    # gives their value then. Constraints do not matter here, they change the pose matrices but not the channels
+    anim = armatureWeird.animation_data
+    curves = {}
+    if (anim != None):
+        if (len(anim.drivers) > 0 or len(anim.nla_tracks) > 0 or anim.use_tweak_mode or anim.action_blend_type != "REPLACE" or anim.action_influence != 1.0):
+            return None
+        if (anim.action != None):
+            for fcurve in anim.action.fcurves:
+                if (not fcurve.mute):
+                    curves[(fcurve.data_path, fcurve.array_index)] = fcurve
+    pbones = armatureWeird.pose.bones
+    transforms = np.empty((len(pbones), 10, len(frames)), dtype=np.float32)
+    for i, pbone in enumerate(pbones):
+        channel = 0
+        for prop, width in ANIMATION_CHANNELS:
+            path = pbone.path_from_id(prop)
+            values = getattr(pbone, prop)
+            for index in range(width):
+                fcurve = curves.get((path, index))
+                if (fcurve != None):
+                    transforms[i, channel] = [fcurve.evaluate(f) for f in frames]
+                else:
+                    transforms[i, channel] = values[index]
+                channel += 1
+    return np.ascontiguousarray(transforms.transpose(2, 0, 1))
+
+def sampleAnimation(scene, armatureWeird, boneMap):
+    # Returns the sampled frame numbers, the bone id of each track and an array of
+    # (frame, track, position x3 + scale x3 + rotation quaternion x4) transforms
+    frames = list(range(scene.frame_start, scene.frame_end + 1))
+    pbones = armatureWeird.pose.bones
+    transforms = sampleCurves(armatureWeird, frames)
+    if (transforms is None):
+        print("BP3D OBJ animation: drivers or NLA in use, sampling {} frames through the scene".format(len(frames)))
+        current = scene.frame_current
+        transforms = np.empty((len(frames), len(pbones), 10), dtype=np.float32)
+        for i, f in enumerate(frames):
             scene.frame_set(f)
-            # The "frame" command takes the frame number
-            file.write("frame {}\n".format(f))
-            for pbone in armatureWeird.pose.bones:
-                # The "transform" command takes the target bone id, the target bone position x3, the target bone scale x3 and the target bone rotation quaternion x4
-                boneId = boneMap[pbone.name]
-                file.write("transform {} {} {} {} {} {} {} {} {} {} {}\n".format(boneId, pbone.location.x, pbone.location.y, pbone.location.z, pbone.scale.x, pbone.scale.y, pbone.scale.z, pbone.rotation_quaternion.w, pbone.rotation_quaternion.x, pbone.rotation_quaternion.y, pbone.rotation_quaternion.z))
-    scene.frame_set(0)
+            transforms[i] = [(*pbone.location[0:3], *pbone.scale[0:3], *pbone.rotation_quaternion[0:4]) for pbone in pbones]
+        scene.frame_set(current)
+    return (frames, [boneMap[pbone.name] for pbone in pbones], transforms)
+
+# Position, scale and rotation channel groups of a transform, with the command writing a key of each group
+KEY_GROUPS = ((0, 3, "position"), (3, 6, "scale"), (6, 10, "rotation"))
+
+def channelError(actual, expected, rotation):
+    # Distance between samples, the angle between the rotations for quaternions
+    if (rotation):
+        actual = actual / np.maximum(np.linalg.norm(actual, axis=-1), 1e-12)[..., None]
+        expected = expected / np.maximum(np.linalg.norm(expected, axis=-1), 1e-12)[..., None]
+        return 2 * np.arccos(np.clip(np.abs(np.sum(actual * expected, axis=-1)), 0, 1))
+    return np.linalg.norm(actual - expected, axis=-1)
+
+def segmentError(values, start, end, rotation):
+    # Largest error of the samples from start to end against the linear (normalized for quaternions) interpolation of both ends
+    t = np.arange(end - start + 1, dtype=np.float64)[:, None] / (end - start)
+    return channelError(values[start:end + 1], values[start] + (values[end] - values[start]) * t, rotation).max()
+
+def reduceKeys(values, tolerance, rotation):
+    # values holds one sample per frame, returns the mask of the frames to keep as keys. A channel which stays within
+    # tolerance of its first sample is reduced to that key, otherwise the first and last frames are always kept
+    count = len(values)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = True
+    if (channelError(values, values[0], rotation).max() <= tolerance):
+        return keep
+    start = 0
+    while (start < count - 1):
+        # Find the furthest end whose segment stays within tolerance by doubling the step, then by bisection
+        good = start + 1
+        step = 1
+        while (good + step < count and segmentError(values, start, good + step, rotation) <= tolerance):
+            good += step
+            step *= 2
+        bad = min(good + step, count)
+        while (bad - good > 1):
+            mid = (good + bad) // 2
+            if (segmentError(values, start, mid, rotation) <= tolerance):
+                good = mid
+            else:
+                bad = mid
+        keep[good] = True
+        start = good
+    return keep
+
+def reduceAnimation(transforms, tolerances):
+    # Returns the transforms with the sign of the quaternions made continuous and a (frame, track, group) key mask,
+    # tolerances gives the position, scale and rotation (in radians) tolerance
+    transforms = transforms.astype(np.float64)
+    rotations = transforms[:, :, 6:10]
+    flips = np.sum(rotations[1:] * rotations[:-1], axis=-1) < 0
+    rotations[1:] *= np.where(np.logical_xor.accumulate(flips, axis=0), -1.0, 1.0)[..., None]
+    keep = np.zeros((transforms.shape[0], transforms.shape[1], len(KEY_GROUPS)), dtype=bool)
+    for track in range(transforms.shape[1]):
+        for group, (first, last, name) in enumerate(KEY_GROUPS):
+            keep[:, track, group] = reduceKeys(transforms[:, track, first:last], tolerances[group], name == "rotation")
+    return (transforms.astype(np.float32), keep)
+
+def writeAnimationFile(frames, boneIds, transforms, file, tolerances = None):
+    # file is the TextWriter of the .animation.bp3d.obj file, it is left open
+    file.write("## BlockProject 3D Object Animation\n")
+    if (tolerances != None):
+        file.write("#use KeyframeReduction\n")
+        file.write("\n")
+        # Only keys are written, a channel is linearly interpolated (normalized for rotations) between its keys
+        # and holds its last key. The "position", "scale" and "rotation" commands take the target bone id
+        # followed by the key values in the same order as the "transform" command
+        transforms, keep = reduceAnimation(transforms, tolerances)
+        lines = []
+        lastFrame = -1
+        for i, track, group in zip(*np.nonzero(keep)):
+            if (i != lastFrame):
+                lines.append("frame {}\n".format(frames[i]))
+                lastFrame = i
+            first, last, name = KEY_GROUPS[group]
+            lines.append("{} {} {}\n".format(name, boneIds[track], " ".join(str(v) for v in transforms[i, track, first:last].tolist())))
+        file.writeLines(lines)
+        print("BP3D OBJ animation: kept {} of {} channel samples ({:.1f}x compression)".format(int(keep.sum()), keep.size, keep.size / max(int(keep.sum()), 1)))
+        return
+    file.write("\n")
+    # The "frame" command takes the frame number
+    # The "transform" command takes the target bone id, the target bone position x3, the target bone scale x3 and the target bone rotation quaternion x4
+    fmt = "frame {}\n" + "".join("transform {}".format(boneId) + " {}" * 10 + "\n" for boneId in boneIds)
+    for f, values in zip(frames, transforms.reshape(len(frames), -1).tolist()):
+        file.write(fmt.format(f, *values))
+
+# Changing how parts are exported must bump this to invalidate existing cache entries
+CACHE_VERSION = 2
+
+class PartCache:
+    """On disk cache of exported parts keyed by a hash of their evaluated geometry, skin, modifiers, transform and
+    export options. An entry holds the part tables, its levels of detail and the text of its main file section"""
+    def __init__(self, directory, maxSize):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, mesh, part, skin, options, local = False):
+        # mesh is the evaluated mesh before triangulation with its split normals computed, local is set for
+        # instanced parts which are exported in object space and therefore do not depend on their transform
+        h = hashlib.sha1("{} {} {}".format(CACHE_VERSION, options, local).encode("utf8"))
+        for collection, attribute, width, dtype in [
+            (mesh.vertices, "co", 3, np.float32),
+            (mesh.loops, "vertex_index", 1, np.int32),
+            (mesh.loops, "normal", 3, np.float32),
+            (mesh.polygons, "loop_total", 1, np.int32)
+        ]:
+            array = np.empty(len(collection) * width, dtype=dtype)
+            collection.foreach_get(attribute, array)
+            h.update(array.tobytes())
+        if (len(mesh.uv_layers) > 0):
+            array = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+            mesh.uv_layers.active.data.foreach_get("uv", array)
+            h.update(array.tobytes())
+        if (not local):
+            h.update(np.array(part.matrix_world, dtype=np.float64).tobytes())
+        h.update(repr([(mod.name, mod.type) for mod in part.modifiers]).encode("utf8"))
+        if (skin != None):
+            for array in (skin.starts, skin.boneIds, skin.weights):
+                h.update(array.tobytes())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        # Returns (data, skin, lods, layout, text) or None, lods is a list of (data, skin, error) and layout the
+        # ObjFile.layout the text was formatted with
+        path = self.path(key)
+        if (not os.path.exists(path)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        os.utime(path)
+        with np.load(path, allow_pickle=False) as entry:
+            def tables(prefix):
+                data = PartData.fromTables(*[entry[prefix + name] for name in ("positions", "normals", "uvs", "corners", "faceStarts")])
+                skin = None
+                if (prefix + "skinStarts" in entry):
+                    skin = SkinData.fromTables(*[entry[prefix + name] for name in ("skinStarts", "skinBoneIds", "skinWeights")])
+                return (data, skin)
+            data, skin = tables("")
+            lods = [(*tables("lod{}_".format(level)), float(entry["lod{}_error".format(level)])) for level in range(int(entry["lodCount"]))]
+            return (data, skin, lods, tuple(entry["layout"].tolist()), entry["text"].tobytes().decode("utf8"))
+
+    def store(self, key, data, skin, lods, layout, text):
+        arrays = {"lodCount": np.array(len(lods)), "layout": np.array(layout, dtype=np.int64), "text": np.frombuffer(text.encode("utf8"), dtype=np.uint8)}
+        for prefix, (data, skin) in [("", (data, skin))] + [("lod{}_".format(level), (lod, lodSkin)) for level, (lod, lodSkin, _) in enumerate(lods)]:
+            arrays.update({prefix + "positions": data.positions, prefix + "normals": data.normals, prefix + "uvs": data.uvs, prefix + "corners": data.corners, prefix + "faceStarts": data.faceStarts})
+            if (skin != None):
+                arrays.update({prefix + "skinStarts": skin.starts, prefix + "skinBoneIds": skin.boneIds, prefix + "skinWeights": skin.weights})
+        for level, (_, _, error) in enumerate(lods):
+            arrays["lod{}_error".format(level)] = np.array(error)
+        # Write then rename so that an interrupted export never leaves a truncated entry
+        temp = self.path(key) + ".tmp"
+        with open(temp, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temp, self.path(key))
+
+    def evict(self):
+        # Least recently used entries go first, load touches the entries it reads
+        entries = []
+        for name in os.listdir(self.directory):
+            if (name.endswith(".npz")):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, name in entries:
+            if (total <= self.maxSize):
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+            evicted += 1
+        return evicted
+
+BINARY_MAGIC = b"BP3DBIN\0"
+BINARY_VERSION = 3
+BINARY_ALIGNMENT = 16
+BINARY_FLAG_ARMATURE = 1
+BINARY_FLAG_ANIMATION = 2
+BINARY_FLAG_VERTEX_STREAM = 4
+BINARY_FLAG_INSTANCES = 8
+# magic, version, flags, section count, bone count, section table offset, bone table offset, animation offset,
+# vertex stream table offset (since version 2), instance table offset (since version 3)
+BINARY_HEADER = struct.Struct("<8sIIIIQQQQQ")
+# vertex, normal, uv, corner, face and influence counts followed by the offsets of the positions, normals, uvs,
+# corners, face starts, influence starts, influence bone ids and influence weights arrays
+BINARY_SECTION = struct.Struct("<6I8Q")
+# name offset in the name blob, name length, head x3, tail x3
+BINARY_BONE = struct.Struct("<II6f")
+# frame count, track count, frame numbers offset, track bone ids offset, transforms offset
+BINARY_ANIMATION = struct.Struct("<IIQQQ")
+# vertex, index and influence counts followed by the offsets of the interleaved vertices, indices, influence
+# starts, influence bone ids and influence weights arrays
+BINARY_STREAM = struct.Struct("<3I4x5Q")
+# instance count followed by the offsets of the section index (u32) and 3x4 world matrix (f32 x12) of each instance
+BINARY_INSTANCES = struct.Struct("<I4xQQ")
+
+class BinaryWriter:
+    """Writes the .bp3d.bin companion file, a packed little endian copy of the exported data meant to be mmapped"""
+    def __init__(self, fileName):
+        fileName = fileName[0:len(fileName) - len(".bp3d.obj")] + ".bp3d.bin"
+        self.file = open(fileName, "wb")
+        self.fileName = fileName
+        self.file.write(bytes(BINARY_HEADER.size))
+        self.flags = 0
+        self.sections = []
+        self.streams = []
+        self.bones = []
+        self.animationOffset = 0
+        self.instanceSections = []
+        self.instanceTransforms = []
+
+    def align(self):
+        self.file.write(bytes(-self.file.tell() % BINARY_ALIGNMENT))
+        return self.file.tell()
+
+    def writeArray(self, array, dtype):
+        if (len(array) == 0):
+            return 0
+        offset = self.align()
+        self.file.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+        return offset
+
+    def writePart(self, data, skin, stream = None):
+        counts = [len(data.positions), len(data.normals), len(data.uvs), len(data.corners), len(data.faceStarts) - 1, 0]
+        offsets = [
+            self.writeArray(data.positions, "<f4"),
+            self.writeArray(data.normals, "<f4"),
+            self.writeArray(data.uvs, "<f4"),
+            self.writeArray(data.corners, "<u4"),
+            self.writeArray(data.faceStarts, "<u4")
+        ]
+        if (skin != None):
+            counts[5] = len(skin.boneIds)
+            offsets += [self.writeArray(skin.starts, "<u4"), self.writeArray(skin.boneIds, "<u4"), self.writeArray(skin.weights, "<f4")]
+        else:
+            offsets += [0, 0, 0]
+        self.sections.append(BINARY_SECTION.pack(*counts, *offsets))
+        if (stream != None):
+            self.flags |= BINARY_FLAG_VERTEX_STREAM
+            counts = [len(stream.vertices), len(stream.indices), 0]
+            offsets = [self.writeArray(stream.vertices, "<f4"), self.writeArray(stream.indices, "<u4")]
+            if (stream.starts is not None):
+                counts[2] = len(stream.boneIds)
+                offsets += [self.writeArray(stream.starts, "<u4"), self.writeArray(stream.boneIds, "<u4"), self.writeArray(stream.weights, "<f4")]
+            else:
+                offsets += [0, 0, 0]
+            self.streams.append(BINARY_STREAM.pack(*counts, *offsets))
+
+    def writeInstances(self, transforms):
+        # Instances of the last written section
+        self.flags |= BINARY_FLAG_INSTANCES
+        self.instanceSections.append(np.full(len(transforms), len(self.sections) - 1, dtype=np.uint32))
+        self.instanceTransforms.append(transforms)
+
+    def writeBones(self, armature):
+        self.flags |= BINARY_FLAG_ARMATURE
+        self.bones = [(bone.name.encode("utf8"), bone.head[0:3], bone.tail[0:3]) for bone in armature.bones]
+
+    def writeAnimation(self, frames, boneIds, transforms):
+        self.flags |= BINARY_FLAG_ANIMATION
+        framesOffset = self.writeArray(np.array(frames), "<i4")
+        tracksOffset = self.writeArray(np.array(boneIds), "<u4")
+        transformsOffset = self.writeArray(transforms, "<f4")
+        self.animationOffset = self.align()
+        self.file.write(BINARY_ANIMATION.pack(len(frames), len(boneIds), framesOffset, tracksOffset, transformsOffset))
+
+    def close(self):
+        sectionsOffset = self.align()
+        self.file.write(b"".join(self.sections))
+        bonesOffset = 0
+        if (len(self.bones) > 0):
+            bonesOffset = self.align()
+            nameOffset = 0
+            for name, head, tail in self.bones:
+                self.file.write(BINARY_BONE.pack(nameOffset, len(name), *head, *tail))
+                nameOffset += len(name)
+            self.file.write(b"".join(name for name, _, _ in self.bones))
+        streamsOffset = 0
+        if (len(self.streams) > 0):
+            streamsOffset = self.align()
+            self.file.write(b"".join(self.streams))
+        instancesOffset = 0
+        if (len(self.instanceSections) > 0):
+            sections = self.writeArray(np.concatenate(self.instanceSections), "<u4")
+            transforms = self.writeArray(np.concatenate(self.instanceTransforms), "<f4")
+            instancesOffset = self.align()
+            self.file.write(BINARY_INSTANCES.pack(sum(len(s) for s in self.instanceSections), sections, transforms))
+        self.file.seek(0)
+        self.file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self.flags, len(self.sections), len(self.bones), sectionsOffset, bonesOffset, self.animationOffset, streamsOffset, instancesOffset))
+        self.file.close()
+
+def outputFiles(fileName, lodCount):
+    # Every file an export to fileName with lodCount levels of detail may write (armature, animation, LODs, binary,
+    # profile), also used by BP3DBatchExport.py to clear earlier outputs
+    base = fileName[0:len(fileName) - len(".bp3d.obj")]
+    names = [".bp3d.obj", ".armature.bp3d.obj", ".animation.bp3d.obj", ".bp3d.bin", ".profile.json", ".prof"]
+    for level in range(lodCount):
+        names += [".lod{}.bp3d.obj".format(level + 1), ".lod{}.armature.bp3d.obj".format(level + 1)]
+    return [base + name for name in names]
 
 class BP3D_Export(bpy.types.Operator, ExportHelper):
     """Export as BlockProject 3D modified Object format"""
@@ -107,107 +1390,526 @@ class BP3D_Export(bpy.types.Operator, ExportHelper):
     bl_label = "BlockProject 3D Export"
     filename_ext = ".bp3d.obj"
 
-    def execute(self, context):
+    modal_export: bpy.props.BoolProperty(
+        name = "Responsive export",
+        description = "Export step by step with progress in the status bar and Esc to cancel, only view navigation is allowed meanwhile",
+        default = False
+    )
+    recursive: bpy.props.BoolProperty(
+        name = "Nested parts",
+        description = "Export the children of children as parts instead of only the direct children",
+        default = True
+    )
+    visible_only: bpy.props.BoolProperty(
+        name = "Visible parts only",
+        description = "Skip children hidden in the view layer",
+        default = False
+    )
+    collection: bpy.props.StringProperty(
+        name = "Collection",
+        description = "Only export children linked to this collection (empty exports all)",
+        default = ""
+    )
+    instancing: bpy.props.BoolProperty(
+        name = "Instancing",
+        description = "Write the geometry of parts sharing the same mesh and modifiers once, followed by the transform of each part",
+        default = False
+    )
+    workers: bpy.props.IntProperty(
+        name = "Worker processes",
+        description = "Processes formatting the parts while the next ones are extracted, 0 or 1 formats them on the main thread. Linux only, parts are formatted on the main thread on other platforms",
+        default = 0,
+        min = 0,
+        max = 64
+    )
+    profiling: bpy.props.EnumProperty(
+        name = "Profiling",
+        description = "Record the time and bytes written of every export stage, the item counts of every part and the size of every written file",
+        items = [
+            ("OFF", "Off", "No profiling"),
+            ("REPORT", "Report", "Write name.profile.json next to the exported file"),
+            ("CPROFILE", "Report and cProfile", "Also write a cProfile capture of the export as name.prof")
+        ],
+        default = "OFF"
+    )
+    chunk_size: bpy.props.IntProperty(
+        name = "Chunk size",
+        description = "Number of rows formatted at once when writing text files",
+        default = 4096,
+        min = 1
+    )
+    export_binary: bpy.props.BoolProperty(
+        name = "Binary sidecar",
+        description = "Also write the exported data to a packed .bp3d.bin file",
+        default = False
+    )
+    streaming: bpy.props.BoolProperty(
+        name = "Streaming export",
+        description = "Flush every part to disk as soon as it is written and report the peak Python/NumPy memory per part along with the peak resident memory of the process",
+        default = False
+    )
+    triangulation: bpy.props.EnumProperty(
+        items = [
+            ("BMESH", "BMesh", "Triangulate and transform a bmesh copy of every part"),
+            ("LOOP_TRIANGLES", "Loop triangles", "Use the mesh loop triangles and transform the extracted arrays")
+        ],
+        name = "Triangulation",
+        description = "How parts are triangulated and moved to world space",
+        default = "BMESH"
+    )
+    normal_weld: bpy.props.FloatProperty(
+        name = "Normal weld distance",
+        description = "Normals are quantized to cells of this size on every axis and normals in the same cell are written once (0 only merges identical normals)",
+        default = 0.0,
+        min = 0.0,
+        precision = 6
+    )
+    uv_weld: bpy.props.FloatProperty(
+        name = "UV weld distance",
+        description = "UVs of the same vertex are quantized to cells of this size on every axis and UVs in the same cell are written once (0 only merges identical UVs)",
+        default = 0.0,
+        min = 0.0,
+        precision = 6
+    )
+    vertex_stream: bpy.props.BoolProperty(
+        name = "Unified vertex stream",
+        description = "Weld face corners into unique vertices and add an interleaved vertex buffer and a triangle index buffer per SubMaterial to the .bp3d.bin",
+        default = False
+    )
+    optimize_vertex_cache: bpy.props.BoolProperty(
+        name = "Optimize vertex cache",
+        description = "Reorder the triangles of every part for the GPU vertex cache, then the vertices by first use",
+        default = False
+    )
+    vertex_cache_size: bpy.props.IntProperty(
+        name = "Vertex cache size",
+        description = "Number of entries of the simulated post transform vertex cache",
+        default = 32,
+        min = 4,
+        max = 64
+    )
+    max_influences: bpy.props.IntProperty(
+        name = "Max influences",
+        description = "Largest number of bones influencing a vertex, the heaviest are kept and renormalized (0 keeps all)",
+        default = 0,
+        min = 0,
+        max = 16
+    )
+    min_weight: bpy.props.FloatProperty(
+        name = "Min weight",
+        description = "Bone influences lighter than this are dropped and the remaining ones renormalized",
+        default = 0.0,
+        min = 0.0,
+        max = 1.0
+    )
+    fixed_influences: bpy.props.BoolProperty(
+        name = "Fixed influence count",
+        description = "Write the same number of influences for every vertex, padded with bone 0 and a weight of 0",
+        default = False
+    )
+    compress_animation: bpy.props.BoolProperty(
+        name = "Keyframe reduction",
+        description = "Only write the animation keys needed to rebuild every channel within the tolerances below",
+        default = False
+    )
+    position_tolerance: bpy.props.FloatProperty(
+        name = "Position tolerance",
+        description = "Largest position error allowed by keyframe reduction",
+        default = 0.0001,
+        min = 0.0
+    )
+    scale_tolerance: bpy.props.FloatProperty(
+        name = "Scale tolerance",
+        description = "Largest scale error allowed by keyframe reduction",
+        default = 0.0001,
+        min = 0.0
+    )
+    rotation_tolerance: bpy.props.FloatProperty(
+        name = "Rotation tolerance",
+        description = "Largest rotation error allowed by keyframe reduction",
+        subtype = "ANGLE",
+        default = 0.001,
+        min = 0.0
+    )
+    lod_count: bpy.props.IntProperty(
+        name = "LOD levels",
+        description = "Number of simplified levels of detail to write next to the model (name.lod1.bp3d.obj, ...)",
+        default = 0,
+        min = 0,
+        max = 8
+    )
+    lod_ratio: bpy.props.FloatProperty(
+        name = "LOD ratio",
+        description = "Fraction of the triangles of the previous level kept by every level of detail",
+        default = 0.5,
+        min = 0.05,
+        max = 0.95
+    )
+    use_cache: bpy.props.BoolProperty(
+        name = "Incremental export",
+        description = "Reuse the result of previous exports for parts whose geometry, transform and options did not change",
+        default = False
+    )
+    cache_dir: bpy.props.StringProperty(
+        name = "Cache directory",
+        description = "Where exported parts are cached, defaults to .bp3d_cache next to the exported file",
+        subtype = "DIR_PATH",
+        default = ""
+    )
+    cache_size: bpy.props.IntProperty(
+        name = "Cache size (MB)",
+        description = "Least recently used cache entries are removed past this size",
+        default = 1024,
+        min = 1
+    )
+
+    def optimizeVertexCache(self, part, data, skin):
+        result = data.optimizeVertexCache(self.vertex_cache_size)
+        if (result != None):
+            (acmr, atvr), (acmr1, atvr1), order = result
+            if (skin != None):
+                skin.reorder(order)
+            print("BP3D OBJ part {}: ACMR {:.3f} -> {:.3f}, ATVR {:.3f} -> {:.3f}".format(part.name, acmr, acmr1, atvr, atvr1))
+        else:
+            print("BP3D OBJ part {}: not triangulated, vertex cache optimization skipped".format(part.name))
+
+    def cacheOptions(self):
+        # Export options changing the content of a cached part
+        return repr((self.triangulation, self.normal_weld, self.uv_weld, self.optimize_vertex_cache, self.vertex_cache_size, self.lod_count, self.lod_ratio, self.chunk_size))
+
+    def extractPart(self, context, part, local = False, evaluated = None):
+        # evaluated is the result of evaluateObject when part was already evaluated, to key the cache
+        if (self.triangulation == "LOOP_TRIANGLES"):
+            evaluated, mesh = objectToLoopTriangles(part, context, evaluated)
+            with stage("extract"):
+                mesh.calc_normals_split()
+                arrays = MeshArrays(mesh)
+                arrays.useLoopTriangles(mesh)
+            if (not local):
+                with stage("transform"):
+                    arrays.transform(part.matrix_world)
+        else:
+            evaluated, mesh = objectToTriangulatedMesh(part, context, local, evaluated)
+            with stage("extract"):
+                mesh.calc_normals_split()
+                arrays = MeshArrays(mesh)
+        data = PartData(arrays, self.normal_weld, self.uv_weld)
+        arrays = None
+        if (self.normal_weld > 0 or self.uv_weld > 0):
+            print("BP3D OBJ part {}: welded {} normals and {} UVs".format(part.name, data.weldedNormals, data.weldedUvs))
+        return (evaluated, mesh, data)
+
+    def buildLods(self, part, data, skin):
+        # Returns a (data, skin, max error) tuple per level of detail, every level is simplified from the previous one
+        lods = []
+        for level in range(self.lod_count):
+            error = 0.0
+            if (data.isTriangulated()):
+                simplifier = Simplifier(data, skin)
+                error = simplifier.run(int(len(data.corners) // 3 * self.lod_ratio))
+                data, order = simplifier.result(data)
+                simplifier = None
+                if (skin != None):
+                    skin = copy.copy(skin)
+                    skin.reorder(order)
+                if (self.optimize_vertex_cache):
+                    self.optimizeVertexCache(part, data, skin)
+            print("BP3D OBJ part {}: LOD {} has {} triangles, max error {}".format(part.name, level + 1, len(data.corners) // 3, error))
+            lods.append((data, skin, error))
+        return lods
+
+    def exportSteps(self, context):
+        # Runs the export one step at a time, yielding (parts done, part count, last step) after every step. The
+        # opened files are closed when the generator is closed early, the caller then removes them with removeOutputs.
+        # self.outputs lists the files opened so far so that files of earlier exports are left alone. context must not be
+        # used once the call that passed it returned: the first step only resolves the exported object, its scene and
+        # armature, every later step gets the context of the call resuming it from send
         filepath = self.filepath
+        base = filepath[0:len(filepath) - len(".bp3d.obj")]
+        self.outputs = []
+        obj = context.object
+        scene = context.scene
         armature = None
         armWeird = None
-        for mod in context.object.modifiers:
+        for mod in obj.modifiers:
             if (mod.type == "ARMATURE"):
                 armature = mod.object.data
                 armWeird = mod.object
-        parts = getParts(context.object)
+        context = yield (0, 0, "started")
+        files = []
+        profiler = None
+        profile = None
+        if (self.profiling != "OFF"):
+            profiler = Profiler(files)
+            Profiler.active = profiler
+        if (self.profiling == "CPROFILE"):
+            profile = cProfile.Profile()
+            profile.enable()
+        with stage("hierarchy"):
+            parts = Hierarchy(scene.objects).getParts(obj, self.recursive, self.visible_only, self.collection)
         print("BP3D OBJ #parts: {}".format(len(parts)))
-        boneMap = None
-        armFile = None
-        if (armature != None):
-            boneMap, armFile = writeArmatureFile(armature, filepath)
-            writeAnimationFile(context.scene, boneMap, armWeird, filepath)
-        with open(filepath, "w", encoding="utf8", newline="\n") as file:
-            file.write("## BlockProject 3D Object\n")
-            file.write("#version 1\n")
+        units = [(part, None) for part in parts]
+        if (self.instancing):
+            if (armature != None):
+                print("BP3D OBJ instancing is not supported with an armature, every part is exported")
+            else:
+                units = groupInstances(parts)
+                print("BP3D OBJ #SubMaterials: {} ({} parts are instances)".format(len(units), sum(len(instances) for _, instances in units if instances != None)))
+        instancing = any(instances != None for _, instances in units)
+        # Cache entries waiting for their text to be formatted
+        pendingEntries = collections.deque()
+        tracing = False
+        pool = createPool(self.workers)
+        try:
+            binFile = None
+            if (self.export_binary or self.vertex_stream):
+                binFile = BinaryWriter(filepath)
+                files.append(binFile)
+                self.outputs.append(binFile.fileName)
+            objFile = ObjFile(filepath, self.chunk_size, len(units), armature, instancing, pool, 2 * self.workers)
+            files.append(objFile)
+            self.outputs += objFile.fileNames()
+            boneMap = objFile.boneMap
+            lodFiles = []
+            for level in range(self.lod_count):
+                lodFiles.append(ObjFile(base + ".lod{}.bp3d.obj".format(level + 1), self.chunk_size, len(units), armature, instancing, pool, 2 * self.workers))
+                files.append(lodFiles[-1])
+                self.outputs += lodFiles[-1].fileNames()
+            cache = None
+            if (self.use_cache):
+                cacheDir = bpy.path.abspath(self.cache_dir) if self.cache_dir != "" else os.path.join(os.path.dirname(filepath), ".bp3d_cache")
+                cache = PartCache(cacheDir, self.cache_size * 1048576)
             if (armature != None):
-                file.write("#use ArmatureAnimation")
-            useMultiMaterial = False
-            if (len(parts) > 1):
-                useMultiMaterial = True
-                file.write("#use MultiMaterial\n")
-                file.write("#AllocMat {}\n".format(len(parts)))
-            file.write("\n")
-            sd = 0
-            vcount = 1
-            ncount = 1
-            uvcount = 1
-            for part in parts:
+                with stage("animation sampling"):
+                    frames, boneIds, transforms = sampleAnimation(scene, armWeird, boneMap)
+                count(frames=len(frames), bones=len(boneIds))
+                tolerances = None
+                if (self.compress_animation):
+                    tolerances = (self.position_tolerance, self.scale_tolerance, self.rotation_tolerance)
+                animFile = TextWriter(base + ".animation.bp3d.obj", self.chunk_size)
+                files.append(animFile)
+                self.outputs.append(animFile.fileName)
+                with stage("animation write"):
+                    writeAnimationFile(frames, boneIds, transforms, animFile, tolerances)
+                if (binFile != None):
+                    with stage("binary"):
+                        binFile.writeBones(armature)
+                        binFile.writeAnimation(frames, boneIds, transforms)
+                context = yield (0, len(units), "animation")
+            tracing = self.streaming and not tracemalloc.is_tracing()
+            if (tracing):
+                tracemalloc.start()
+            for index, (part, instances) in enumerate(units):
                 print(part.type)
-                file.write("\n")
-                #SubMaterial (index of sub material, number to subtract to vertex id, number to subtract to uv id, number to subtract to normal id)
-                if (useMultiMaterial):
-                    file.write("#SubMaterial {} {} {} {}\n".format(sd, vcount, uvcount, ncount))
-                mesh = objectToTriangulatedMesh(part, context)
-                uvlayer = None
-                if (len(mesh.uv_layers) > 0):
-                    uvlayer = mesh.uv_layers.active.data[:]
-                facePairs = [(face, index) for index, face in enumerate(mesh.polygons)]
-                mesh.calc_normals_split()
-                file.write("## Vertices\n")
-                for v in mesh.vertices:
-                    file.write("v {} {} {}\n".format(v.co.x, v.co.y, v.co.z))
+                if (profiler != None):
+                    profiler.beginPart(part.name)
+                local = instances != None
+                transforms = None
+                if (local):
+                    transforms = instanceTransforms(instances)
+                if (self.streaming):
+                    resetPeakMemory()
+                skin = None
+                key = None
+                entry = None
+                evaluated = None
+                if (cache != None):
+                    # The key needs the skin and the evaluated mesh, which both come from the mesh before triangulation.
+                    # On a miss that mesh is triangulated and extracted instead of evaluating the part again
+                    evaluated = evaluateObject(part, context)
+                    mesh = evaluated[1]
+                    with stage("evaluate"):
+                        mesh.calc_normals_split()
                     if (armature != None):
-                        cmd = "vb"
-                        cmd1 = "vw"
-                        for group in v.groups:
-                            boneId = boneMap[part.vertex_groups[group.group].name]
-                            cmd += " {}".format(boneId)
-                            cmd1 += " {}".format(group.weight)
-                        cmd += "\n"
-                        cmd1 += "\n"
-                        armFile.write(cmd)
-                        armFile.write(cmd1)
-                file.write("## Normals\n")
-                normalMap = {}
-                loopsToNormals = [0] * len(mesh.loops)
-                nsubcount = 0
-                for f, id in facePairs:
-                    for lid in f.loop_indices:
-                        key = key3d(mesh.loops[lid].normal)
-                        val = normalMap.get(key)
-                        if (val is None):
-                            val = nsubcount
-                            normalMap[key] = val
-                            nsubcount += 1
-                            file.write("vn {} {} {}\n".format(key[0], key[1], key[2]))
-                        loopsToNormals[lid] = val
-                file.write("## UVs\n")
-                uvMap = {}
-                uvToFace = [None] * len(facePairs)
-                uvsubcount = 0
-                for f, fid in facePairs:
-                    uvlist = []
-                    uvToFace[fid] = uvlist
-                    for uvid, lid in enumerate(f.loop_indices):
-                        uv = uvlayer[lid].uv
-                        key = (mesh.loops[lid].vertex_index, key2d(uv))
-                        val = uvMap.get(key)
-                        if (val is None):
-                            val = uvsubcount
-                            uvMap[key] = val
-                            uvsubcount += 1
-                            file.write("vt {} {}\n".format(uv.x, uv.y))
-                        uvlist.append(val)
-                file.write("## Faces\n")
-                for f, fid in facePairs:
-                    file.write("f")
-                    faces = [(vi, mesh.vertices[vid], lid) for vi, (vid, lid) in enumerate(zip(f.vertices, f.loop_indices))]
-                    for vi, v, li in faces:
-                        file.write(" {}/{}/{}".format(vcount + v.index, uvcount + uvToFace[fid][vi], ncount + loopsToNormals[li]))
-                    file.write("\n")
-                vcount += len(mesh.vertices)
-                uvcount += uvsubcount
-                ncount += nsubcount
-                sd += 1
-        if (armFile != None):
-            armFile.close()
-        return {'FINISHED'}
+                        with stage("skin"):
+                            skin = SkinData(mesh, part, boneMap, self.max_influences, self.min_weight)
+                    with stage("cache"):
+                        key = cache.key(mesh, part, skin, self.cacheOptions(), local)
+                        mesh = None
+                        entry = cache.load(key)
+                    if (entry != None):
+                        evaluated[0].to_mesh_clear()
+                        evaluated = None
+                text = None
+                if (entry != None):
+                    data, skin, lods, layout, text = entry
+                    if (layout != objFile.layout()):
+                        # Earlier parts changed size or the part count changed, the section has to be formatted again
+                        text = None
+                else:
+                    evaluated, mesh, data = self.extractPart(context, part, local, evaluated)
+                    if (armature != None and skin == None):
+                        with stage("skin"):
+                            skin = SkinData(mesh, part, boneMap, self.max_influences, self.min_weight)
+                    evaluated.to_mesh_clear()
+                    mesh = None
+                    if (self.optimize_vertex_cache):
+                        with stage("vertex cache"):
+                            self.optimizeVertexCache(part, data, skin)
+                    with stage("lod"):
+                        lods = self.buildLods(part, data, skin)
+                    if (cache != None):
+                        # With a pool text is the future of the worker formatting the section, the entry is stored
+                        # once it is done
+                        text = objFile.formatPart(data)
+                        pendingEntries.append((key, data, skin, lods, objFile.layout(), text))
+                        self.storeEntries(cache, pendingEntries, False)
+                count(faces=len(data.faceStarts) - 1, positions=len(data.positions), normals=len(data.normals), uvs=len(data.uvs))
+                if (skin != None):
+                    count(influences=len(skin.boneIds))
+                context = yield (index, len(units), "{} extracted".format(part.name))
+                written = bytesWritten(files)
+                if (skin != None and self.fixed_influences):
+                    skin = skin.padded(self.max_influences)
+                with stage("write"):
+                    objFile.writePart(data, skin, text, transforms)
+                text = None
+                if (binFile != None):
+                    with stage("binary"):
+                        stream = None
+                        if (self.vertex_stream):
+                            stream = VertexStream(data, skin)
+                            print("BP3D OBJ part {}: {} corners welded into {} vertices".format(part.name, len(data.corners), len(stream.vertices)))
+                        binFile.writePart(data, skin, stream)
+                        stream = None
+                        if (local):
+                            binFile.writeInstances(transforms)
+                with stage("write"):
+                    for level, (lod, lodSkin, error) in enumerate(lods):
+                        if (lodSkin != None and self.fixed_influences):
+                            lodSkin = lodSkin.padded(self.max_influences)
+                        lodFiles[level].write("## LOD {}: {} triangles, max error {}\n".format(level + 1, len(lod.corners) // 3, error))
+                        lodFiles[level].writePart(lod, lodSkin, None, transforms)
+                if (pool == None):
+                    # With worker processes the writes are queued and happen later, they cannot be attributed to a part
+                    count(bytes=bytesWritten(files) - written)
+                data = None
+                skin = None
+                lods = None
+                if (self.streaming):
+                    objFile.flush()
+                    for lodFile in lodFiles:
+                        lodFile.flush()
+                    peak = peakMemory()
+                    resident = peakResidentMemory()
+                    if (resident != None):
+                        print("BP3D OBJ part {}: peak Python/NumPy memory {:.1f} MB, process peak resident memory {:.1f} MB".format(part.name, peak / 1048576, resident / 1048576))
+                    else:
+                        print("BP3D OBJ part {}: peak Python/NumPy memory {:.1f} MB".format(part.name, peak / 1048576))
+                if (profiler != None):
+                    profiler.endPart()
+                context = yield (index + 1, len(units), "{} written".format(part.name))
+            with stage("write"):
+                # Sections the workers are still formatting are written here
+                for file in [objFile] + lodFiles:
+                    file.flush()
+            if (cache != None):
+                self.storeEntries(cache, pendingEntries, True)
+        finally:
+            if (tracing):
+                tracemalloc.stop()
+            for file in files:
+                file.close()
+            if (pool != None):
+                pool.shutdown()
+            if (profile != None):
+                profile.disable()
+            Profiler.active = None
+        if (cache != None):
+            evicted = cache.evict()
+            print("BP3D OBJ cache: {} hits, {} misses, {} entries evicted".format(cache.hits, cache.misses, evicted))
+        if (profile != None):
+            self.outputs.append(base + ".prof")
+            profile.dump_stats(base + ".prof")
+        if (profiler != None):
+            # Sizes of the files this run wrote, not of outputs left by earlier exports with other options
+            written = list(self.outputs)
+            self.outputs.append(base + ".profile.json")
+            profiler.save(base + ".profile.json", written)
+            print("BP3D OBJ profile written to {}".format(base + ".profile.json"))
+
+    def storeEntries(self, cache, entries, wait):
+        # Stores the pending cache entries whose text is formatted, in order, and all of them when wait is set
+        while (len(entries) > 0):
+            key, data, skin, lods, layout, text = entries[0]
+            if (isinstance(text, concurrent.futures.Future)):
+                if (not wait and not text.done()):
+                    break
+                text = text.result()
+            with stage("cache"):
+                cache.store(key, data, skin, lods, layout, text)
+            entries.popleft()
+
+    def outputFiles(self):
+        # Every file an export with these options may write, whether or not this run wrote it
+        return outputFiles(self.filepath, self.lod_count)
+
+    def removeOutputs(self):
+        # Only the files opened by this run, outputs of earlier exports with other options are kept
+        for fileName in self.outputs:
+            if (os.path.exists(fileName)):
+                os.remove(fileName)
+
+    def execute(self, context):
+        # The first step resolves what is exported while this context is valid, later steps are sent the current one
+        self.steps = self.exportSteps(context)
+        next(self.steps)
+        if (not self.modal_export or bpy.app.background or context.window == None):
+            try:
+                while (True):
+                    self.steps.send(context)
+            except StopIteration:
+                pass
+            return {'FINISHED'}
+        # The export goes on from modal, one step per timer event so that the interface keeps refreshing
+        wm = context.window_manager
+        self.timer = wm.event_timer_add(0.001, window=context.window)
+        wm.progress_begin(0, 1000)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def finish(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        if (context.workspace != None):
+            context.workspace.status_text_set(None)
+
+    def abort(self, context):
+        # Stops the export, the generator closes the opened files which are then removed
+        self.finish(context)
+        self.steps.close()
+        self.removeOutputs()
+
+    def cancel(self, context):
+        # Called instead of modal when Blender ends the operator itself, on file load or when the window is closed
+        self.abort(context)
+        print("BP3D OBJ export cancelled by Blender, partial files removed")
+
+    def modal(self, context, event):
+        if (event.type == "ESC"):
+            self.abort(context)
+            self.report({'WARNING'}, "BP3D export cancelled, partial files removed")
+            return {'CANCELLED'}
+        if (event.type in NAVIGATION_EVENTS):
+            return {'PASS_THROUGH'}
+        if (event.type != "TIMER"):
+            # The export holds references to the scene objects, editing or undoing would invalidate them
+            return {'RUNNING_MODAL'}
+        try:
+            done, total, step = self.steps.send(context)
+        except StopIteration:
+            self.finish(context)
+            self.report({'INFO'}, "BP3D export finished")
+            return {'FINISHED'}
+        except Exception as e:
+            traceback.print_exc()
+            self.abort(context)
+            self.report({'ERROR'}, "BP3D export failed: {}".format(e))
+            return {'CANCELLED'}
+        context.window_manager.progress_update(int(1000 * done / max(total, 1)))
+        context.workspace.status_text_set("BP3D export: {} ({}/{} parts), Esc to cancel".format(step, done, total))
+        return {'RUNNING_MODAL'}
 
 def exportMenuEntry(self, nwjerptbm):
     self.layout.operator(BP3D_Export.bl_idname, text="BlockProject 3D")